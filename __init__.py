@@ -0,0 +1,17 @@
+#add-on entry point, the folder is installed as one package so its modules import each other relatively
+bl_info = {
+    "name": "Vizor Face Rigging",
+    "blender": (2, 80, 0),
+    "category": "Object",
+}
+
+#bpy is only imported on register, so mesh_utils, lid_planner, lid_format and record_store import without blender
+#for batch pipelines, benchmarks and tests
+
+def register():
+    from . import ui
+    ui.register()
+
+def unregister():
+    from . import ui
+    ui.unregister()
@@ -0,0 +1,163 @@
+#headless lid rigging for many .blend files
+#run with: blender --background --python batch_rig.py -- manifest.json --jobs 4 --output results.json
+#or from plain python: python batch_rig.py manifest.json --blender /path/to/blender
+#
+#manifest layout, paths are relative to the manifest file:
+#{
+#    "jobs": [
+#        {
+#            "file": "test.blend",
+#            "output": "rigged/test.blend",
+#            "lids": [
+#                {"name": "L", "armature": "metarig", "mesh_object": "Head", "upper": [1, 2, 3], "lower": [4], "bones": 0, "mode": "ACTION", "mirror": true}
+#            ]
+#        },
+#        {"file": "other_head.blend", "definition": "head.vzlid", "mesh_object": "Head", "armature": "metarig"}
+#    ]
+#}
+#a definition file (see lid_format.py) replaces "lids" and rigs every head of the same topology,
+#"mesh_object" and "armature" override the names stored in it
+import argparse, importlib, json, os, subprocess, sys, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def script_args(argv):
+    '''Arguments after "--" when run inside blender, all of them otherwise'''
+    return argv[argv.index("--") + 1:] if "--" in argv else argv[1:]
+
+def load_manifest(path: str):
+    '''Reads the manifest and makes file paths absolute'''
+    with open(path) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = manifest.get("jobs", [])
+    for job in jobs:
+        if "file" not in job or not (job.get("lids") or job.get("definition")):
+            raise ValueError(f"Job {job} needs a file and at least one lid or a lid definition")
+        job["file"] = os.path.join(base, job["file"])
+        if job.get("definition"):
+            job["definition"] = os.path.join(base, job["definition"])
+        if job.get("output"):
+            job["output"] = os.path.join(base, job["output"])
+    return jobs
+
+def run_job(blender: str, job: dict, timeout: float):
+    '''Rigs one file in its own blender process and returns its result record'''
+    with tempfile.TemporaryDirectory() as tmp:
+        job_path = os.path.join(tmp, "job.json")
+        result_path = os.path.join(tmp, "result.json")
+        with open(job_path, "w") as f:
+            json.dump(job, f)
+        command = [blender, "--background", "--factory-startup", job["file"],
+                   "--python", os.path.abspath(__file__), "--", "--worker", job_path, result_path]
+        start = time.perf_counter()
+        try:
+            process = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return {"file": job["file"], "status": "error", "error": f"timed out after {timeout}s",
+                    "wall_time": time.perf_counter() - start}
+        wall_time = time.perf_counter() - start
+        if os.path.exists(result_path):
+            with open(result_path) as f:
+                result = json.load(f)
+        else:
+            result = {"file": job["file"], "status": "error", "error": process.stderr[-2000:] or "worker wrote no result"}
+    result["wall_time"] = wall_time
+    result["returncode"] = process.returncode
+    return result
+
+def drive(argv):
+    '''Fans manifest jobs out over a pool of blender processes and writes results to JSON'''
+    parser = argparse.ArgumentParser(description="Apply the lid rig to many .blend files")
+    parser.add_argument("manifest")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="blender processes run at once")
+    parser.add_argument("--output", default="batch_results.json")
+    parser.add_argument("--blender", default=os.environ.get("BLENDER"), help="blender binary, defaults to the running one")
+    parser.add_argument("--timeout", type=float, default=3600, help="seconds allowed per file")
+    args = parser.parse_args(argv)
+
+    blender = args.blender
+    if not blender:
+        try:
+            import bpy
+            blender = bpy.app.binary_path
+        except ImportError:
+            parser.error("--blender or BLENDER is required outside blender")
+    jobs = load_manifest(args.manifest)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        results = list(pool.map(lambda job: run_job(blender, job, args.timeout), jobs))
+    report = {
+        "manifest": os.path.abspath(args.manifest),
+        "jobs": args.jobs,
+        "total_time": time.perf_counter() - start,
+        "failed": sum(result["status"] != "ok" for result in results),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{len(results) - report['failed']}/{len(results)} files rigged in {report['total_time']:.1f}s, results in {args.output}")
+    return 1 if report["failed"] else 0
+
+def work(job_path: str, result_path: str):
+    '''Runs inside a blender worker that already opened the job file'''
+    import bpy
+    #the add-on folder is a package, imported by its folder name
+    sys.path.append(os.path.dirname(_DIR))
+    ui = importlib.import_module(f"{os.path.basename(_DIR)}.ui")
+
+    with open(job_path) as f:
+        job = json.load(f)
+    result = {"file": job["file"], "output": job.get("output"), "status": "ok", "timings": {}}
+    timings = result["timings"]
+    try:
+        start = time.perf_counter()
+        ui.register()
+        context = bpy.context
+        names = []
+        if job.get("definition"):
+            mesh_obj = ui.get_object(job["mesh_object"], "Mesh Object") if job.get("mesh_object") else None
+            names += ui.import_lid_definition(context, job["definition"], mesh_obj, job.get("armature", ""))
+        for lid in job.get("lids", []):
+            #lid definitions replace rigs of the same name already saved in the file
+            existing = context.scene.lid_rigs.find(lid["name"])
+            rig = context.scene.lid_rigs[existing] if existing != -1 else context.scene.lid_rigs.add()
+            rig.name = lid["name"]
+            rig.armature = lid["armature"]
+            rig.bone_count = lid.get("bones", 0) #0 keeps one bone per vertex
+            rig.mode = lid.get("mode", 'ACTION')
+            rig.mirror = lid.get("mirror", False) #also rigs the opposite side, named R for L
+            ui.set_rig_lids(rig, ui.get_object(lid["mesh_object"], "Mesh Object"), lid["upper"], lid["lower"])
+            names.append(rig.name)
+        sources = list(dict.fromkeys(names))
+        names = list(dict.fromkeys(sources + [ui.mirror_side(name) for name in sources if context.scene.lid_rigs[name].mirror]))
+        timings["setup"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ui.generate_rigs(context, [context.scene.lid_rigs[name] for name in sources])
+        timings["generate"] = time.perf_counter() - start
+        rigs = [context.scene.lid_rigs[name] for name in names]
+        result["rigs"] = len(rigs)
+        result["bones"] = sum(len(rig.upper.bones) + len(rig.lower.bones) + 1 for rig in rigs)
+
+        if job.get("output"):
+            start = time.perf_counter()
+            os.makedirs(os.path.dirname(job["output"]), exist_ok=True)
+            bpy.ops.wm.save_as_mainfile(filepath=job["output"])
+            timings["save"] = time.perf_counter() - start
+    except Exception as error:
+        result["status"] = "error"
+        result["error"] = f"{type(error).__name__}: {error}"
+    with open(result_path, "w") as f:
+        json.dump(result, f)
+
+def main(argv):
+    args = script_args(argv)
+    if args and args[0] == "--worker":
+        work(args[1], args[2])
+        return 0
+    return drive(args)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,422 @@
+#headless benchmark suite for the lid rigging pipeline
+#run with: blender --background --python benchmark.py -- --output bench.json [--quick] [--blend test.blend]
+#plain python (python benchmark.py -- --output plan.json) runs the bpy-free planner benchmarks only
+#every record is {"suite", "stage", "params", "seconds"}, compare files between releases to catch regressions
+import argparse, importlib, json, os, platform, sys, time
+import numpy as np
+
+_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.dirname(_DIR))
+_PACKAGE = os.path.basename(_DIR)
+lid_planner, mesh_utils = (importlib.import_module(f"{_PACKAGE}.{name}") for name in ("lid_planner", "mesh_utils"))
+mesh_edge_array, mesh_selection, walk_loop = mesh_utils.mesh_edge_array, mesh_utils.mesh_selection, mesh_utils.walk_loop
+walk_bmesh_loop = mesh_utils.walk_bmesh_loop
+try:
+    import bpy, bmesh
+except ImportError: #outside blender
+    bpy = None
+else:
+    ui, eye_bones = (importlib.import_module(f"{_PACKAGE}.{name}") for name in ("ui", "eye_bones"))
+
+_LOOP_SIZES = (10, 100, 1000, 10000, 100000)
+_LID_SIZES = (10, 100, 1000)
+_BONE_COUNTS = (0, 1000, 10000)
+_GRID_SIDES = (100, 316, 1000) #10k, 100k and 1M vertex meshes
+_WEIGHT_SIZES = ((1000, 10), (10000, 100), (100000, 500)) #(weighted verts, DEF groups)
+_BASE_LID, _BASE_BONES, _BASE_SIDE = 100, 1000, 316
+_PLAYBACK_HEADS = (1, 10, 50) #rigged heads evaluated together
+_PLAYBACK_SIDE, _PLAYBACK_FRAMES = 100, 48
+_PLAYBACK_BONES = 8 #resampled bones per lid in both modes, B-Bone segments in BBONE mode
+_GRID_SPACING = 0.001
+
+def legacy_find_connected(vertex, mesh, visited=None):
+    '''Recursive walker the add-on used before mesh_utils.walk_loop, kept as baseline'''
+    if visited is None:
+        visited = set()
+    visited.add(vertex.index)
+    connected_vertices = [vertex]
+    for edge in vertex.link_edges:
+        linked_vert = edge.other_vert(vertex)
+        if linked_vert.select and linked_vert.index not in visited:
+            connected_vertices.extend(legacy_find_connected(linked_vert, mesh, visited))
+    return connected_vertices
+
+def legacy_assign_weights(obj, vert_group: str):
+    '''Per vertex weight writer eye_bones.assign_weights used before grouping, kept as baseline'''
+    if vert_group in obj:
+        verts = obj[vert_group]
+        if verts and obj:
+            for vert in verts:
+                group_index = obj.vertex_groups.find(vert['weight'])
+                if group_index != -1:
+                    weight = obj.vertex_groups[vert['weight']]
+                    weight.add([vert['index']], 1, 'REPLACE')
+                    weight.lock_weight = True
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+class Recorder():
+    '''Collects benchmark records and prints them as they come'''
+    def __init__(self):
+        self.records = []
+
+    def add(self, suite: str, stage: str, seconds, **params):
+        self.records.append({"suite": suite, "stage": stage, "params": params, "seconds": seconds})
+        shown = "n/a" if seconds is None else f"{seconds * 1000:.2f} ms"
+        print(f"{suite:>10} {stage:<24} {shown:>14}  {params}")
+
+def clear_scene():
+    if bpy.context.object and bpy.context.object.mode != 'OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+    bpy.context.scene.lid_rigs.clear()
+    for collection in (bpy.data.objects, bpy.data.armatures, bpy.data.meshes, bpy.data.actions):
+        for block in list(collection):
+            collection.remove(block)
+
+def make_loop_mesh(size: int):
+    '''Creates an open chain of size selected verts, returns (mesh, bmesh)'''
+    bm = bmesh.new()
+    verts = [bm.verts.new((i * 0.001, 0, 0)) for i in range(size)]
+    for a, b in zip(verts[:-1], verts[1:]):
+        bm.edges.new((a, b))
+    for vert in verts:
+        vert.select = True
+    bm.verts.index_update()
+    mesh = bpy.data.meshes.new(f"bench_loop_{size}")
+    bm.to_mesh(mesh)
+    return mesh, bm
+
+def make_armature(bone_count: int):
+    '''Creates an armature object with bone_count filler bones, linked to the scene'''
+    armature = bpy.data.armatures.new("bench_rig")
+    obj = bpy.data.objects.new(armature.name, armature)
+    bpy.context.scene.collection.objects.link(obj)
+    bpy.context.view_layer.objects.active = obj
+    bpy.ops.object.mode_set(mode='EDIT')
+    for i in range(bone_count):
+        bone = armature.edit_bones.new(f"filler_{i}")
+        bone.head = (i * 0.01, 1, 0)
+        bone.tail = (i * 0.01, 1, 0.01)
+    bpy.ops.object.mode_set(mode='OBJECT')
+    return obj
+
+def make_grid_object(side: int):
+    '''Creates a side x side vertex grid with edges only, built with foreach_set'''
+    xs, ys = np.meshgrid(np.arange(side), np.arange(side))
+    co = np.stack((xs.ravel(), np.zeros(side * side), ys.ravel()), axis=1) * _GRID_SPACING
+    index = np.arange(side * side).reshape(side, side)
+    edges = np.concatenate((
+        np.stack((index[:, :-1].ravel(), index[:, 1:].ravel()), axis=1),
+        np.stack((index[:-1].ravel(), index[1:].ravel()), axis=1),
+    ))
+    mesh = bpy.data.meshes.new(f"bench_head_{side}")
+    mesh.vertices.add(len(co))
+    mesh.vertices.foreach_set("co", co.astype(np.float32).ravel())
+    mesh.edges.add(len(edges))
+    mesh.edges.foreach_set("vertices", edges.astype(np.int32).ravel())
+    mesh.update()
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    return obj
+
+def make_face_grid_object(side: int, hole: int):
+    '''Creates a side x side quad grid with two hole x hole eye holes either side of X = 0'''
+    xs, ys = np.meshgrid(np.arange(side) - (side - 1) / 2, np.arange(side))
+    co = np.stack((xs.ravel(), np.zeros(side * side), ys.ravel()), axis=1) * _GRID_SPACING
+    index = np.arange(side * side).reshape(side, side)
+    quads = np.stack((index[:-1, :-1], index[:-1, 1:], index[1:, 1:], index[1:, :-1]), axis=-1)
+    keep = np.ones(quads.shape[:2], dtype=bool)
+    row, offset = (side - hole) // 2, side // 4
+    for col in (offset - hole // 2, side - 1 - offset - hole // 2):
+        keep[row:row + hole, col:col + hole] = False
+    quads = quads[keep].reshape(-1, 4)
+    mesh = bpy.data.meshes.new(f"bench_face_head_{side}")
+    mesh.vertices.add(len(co))
+    mesh.vertices.foreach_set("co", co.astype(np.float32).ravel())
+    mesh.loops.add(quads.size)
+    mesh.loops.foreach_set("vertex_index", quads.astype(np.int32).ravel())
+    mesh.polygons.add(len(quads))
+    mesh.polygons.foreach_set("loop_start", np.arange(0, quads.size, 4, dtype=np.int32))
+    mesh.polygons.foreach_set("loop_total", np.full(len(quads), 4, dtype=np.int32))
+    mesh.update(calc_edges=True)
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    return obj
+
+def grid_lids(side: int, size: int):
+    '''Upper lid row of size verts and lower lid row of size-2 verts in the middle of the grid'''
+    size = min(size, side)
+    row = side // 2
+    upper = row * side + np.arange(size)
+    lower = (row - 1) * side + np.arange(1, size - 1)
+    return upper, lower
+
+def setup_rig(side: int, size: int, bone_count: int, name: str = "L", mode: str = 'ACTION'):
+    '''Grid head, armature and a lid rig filled as add_indicies would, returns the rig'''
+    armature = make_armature(bone_count)
+    mesh_obj = make_grid_object(side)
+    rig = bpy.context.scene.lid_rigs.add()
+    rig.name = name
+    rig.armature = armature.name
+    rig.mode = mode
+    ui.set_rig_lids(rig, mesh_obj, *grid_lids(side, size))
+    return rig
+
+def select_loop(mesh_obj, indices):
+    '''Selects indices in edit mode with the first one active, as an artist would'''
+    bm = bmesh.from_edit_mesh(mesh_obj.data)
+    bm.verts.ensure_lookup_table()
+    for vert in bm.verts:
+        vert.select = False
+    for edge in bm.edges:
+        edge.select = False
+    for i in indices.tolist():
+        bm.verts[i].select = True
+    bm.select_history.clear()
+    bm.select_history.add(bm.verts[int(indices[0])])
+    bmesh.update_edit_mesh(mesh_obj.data)
+
+def bench_loop_walk(recorder, sizes=_LOOP_SIZES):
+    '''Times the recursive walker against the array and BMesh walkers on synthetic loops'''
+    for size in sizes:
+        mesh, bm = make_loop_mesh(size)
+        bm.verts.ensure_lookup_table()
+        try:
+            legacy, _ = timed(legacy_find_connected, bm.verts[0], bm)
+        except RecursionError:
+            legacy = None #recursion limit
+        walk = lambda: walk_loop(mesh_edge_array(mesh), mesh_selection(mesh), 0)
+        current, result = timed(walk)
+        assert len(result.order) == size and not result.closed and not len(result.branches)
+        recorder.add("loop_walk", "findConnected", legacy, size=size)
+        recorder.add("loop_walk", "walk_loop", current, size=size)
+        bmesh_walk, result = timed(walk_bmesh_loop, bm.verts[0])
+        assert len(result.order) == size and not result.closed
+        recorder.add("loop_walk", "walk_bmesh_loop", bmesh_walk, size=size)
+        bm.free()
+        bpy.data.meshes.remove(mesh)
+
+def bench_add_indicies(recorder, side: int, size: int):
+    '''Times the add lid operator for both lids on a grid head'''
+    clear_scene()
+    armature = make_armature(0)
+    mesh_obj = make_grid_object(side)
+    rig = bpy.context.scene.lid_rigs.add()
+    rig.armature = armature.name
+    bpy.context.view_layer.objects.active = mesh_obj
+    bpy.ops.object.mode_set(mode='EDIT')
+    upper, lower = grid_lids(side, size)
+    for layer, indices in (('TOP', upper), ('BOTTOM', lower)):
+        select_loop(mesh_obj, indices)
+        seconds, _ = timed(bpy.ops.object.vizor_add_lid, 'EXEC_DEFAULT', lidLayer=layer, lidIndex=0, add=True)
+        recorder.add("pipeline", f"add_indicies_{layer.lower()}", seconds, verts=side * side, lid=len(indices))
+    bpy.ops.object.mode_set(mode='OBJECT')
+
+def bench_plan(recorder, sizes=_LID_SIZES):
+    '''Times the pure planner on a synthetic lid, fresh and from its cache'''
+    for size in sizes:
+        t = np.linspace(0, np.pi, size)
+        upper = np.stack((np.cos(t), np.zeros(size), np.sin(t) * 0.3), axis=1)
+        lower = upper[1:-1] * (1, 1, -0.5)
+        inputs = ("L", "bench_rig", "bench_head", np.arange(size), upper, np.arange(size, 2 * size - 2), lower, np.eye(4))
+        for mode, bone_count in (('ACTION', 0), ('ACTION', 10), ('BBONE', 0)):
+            lid_planner._plan_cache.clear()
+            seconds, _ = timed(lid_planner.plan_rig, *inputs, mode, bone_count)
+            recorder.add("plan", "plan_rig", seconds, lid=size, mode=mode, bones=bone_count)
+            seconds, _ = timed(lid_planner.plan_rig, *inputs, mode, bone_count)
+            recorder.add("plan", "plan_rig_cached", seconds, lid=size, mode=mode, bones=bone_count)
+
+def bench_generate(recorder, side: int, size: int, bone_count: int):
+    '''Times each generate stage separately on a fresh rig, then regenerate and weighting'''
+    clear_scene()
+    rig = setup_rig(side, size, bone_count)
+    params = {"verts": side * side, "lid": len(rig.upper.indices), "bones": bone_count}
+    context = bpy.context
+    plans = [ui.RigPlan(rig)]
+    changes = [plan.changed_bones() for plan in plans]
+    seconds, _ = timed(ui.generate_bones, context, plans, changes)
+    recorder.add("pipeline", "generate_bones", seconds, **params)
+    #controller alone, it is placed in the same edit session as the lid bones
+    ctrl_changes = [({plan.ctrl_bone}, set()) for plan in plans]
+    seconds, _ = timed(ui.generate_bones, context, plans, ctrl_changes)
+    recorder.add("pipeline", "generate_controller", seconds, **params)
+    seconds, _ = timed(ui.generate_actions, context, plans, changes)
+    recorder.add("pipeline", "generate_action", seconds, **params)
+    for plan in plans:
+        plan.store()
+    seconds, _ = timed(ui.generate_rigs, context, [rig])
+    recorder.add("pipeline", "regenerate_noop", seconds, **params)
+    seconds, _ = timed(ui.generate_rigs, context, [rig], True)
+    recorder.add("pipeline", "regenerate_full", seconds, **params)
+
+    #weights on the lid verts, flat and with geodesic falloff
+    mesh_obj = ui.get_object(rig.mesh_object, "Mesh Object")
+    store = eye_bones.vertex_records(mesh_obj)
+    for lid in (rig.upper, rig.lower):
+        store.upsert_many(lid.indices, lid.coordinates, lid.bones, [f"DEF-{bone}" for bone in lid.bones])
+    store.save()
+    seconds, _ = timed(eye_bones.assign_weights, mesh_obj, "vertices", True)
+    recorder.add("pipeline", "assign_weights", seconds, **params)
+    seconds, _ = timed(eye_bones.assign_weights, mesh_obj, "vertices", True, 5 * _GRID_SPACING)
+    recorder.add("pipeline", "assign_weights_falloff", seconds, **params)
+
+def bench_detect(recorder, side: int, hole: int = 10):
+    '''Times eye hole detection and lid filling on a quad grid'''
+    clear_scene()
+    armature = make_armature(0)
+    mesh_obj = make_face_grid_object(side, hole)
+    seconds, names = timed(ui.detect_rig_lids, bpy.context, mesh_obj, armature.name)
+    recorder.add("pipeline", "detect_lids", seconds, polygons=len(mesh_obj.data.polygons), rigs=len(names))
+
+def bench_bake(recorder, side: int, size: int):
+    '''Times baking a resampled lid rig to a shape key, with and without removing the rig'''
+    clear_scene()
+    rig = setup_rig(side, size, 0)
+    rig.bone_count = 10 #resampled lids write vertex weights, per vertex bones do not
+    ui.generate_rigs(bpy.context, [rig])
+    mesh_obj = ui.get_object(rig.mesh_object, "Mesh Object")
+    mesh_obj.modifiers.new("Armature", 'ARMATURE').object = ui.get_object(rig.armature, "Armature")
+    params = {"verts": side * side, "lid": len(rig.upper.indices)}
+    seconds, moved = timed(ui.bake_lid_shape_key, bpy.context, rig)
+    recorder.add("bake", "shape_key", seconds, moved=moved, **params)
+    seconds, _ = timed(ui.remove_lid_rig, bpy.context, rig)
+    recorder.add("bake", "remove_rig", seconds, **params)
+
+def bench_playback(recorder, heads: int, size: int, mode: str, frames: int = _PLAYBACK_FRAMES):
+    '''Frames per second of a scene with heads deforming lid rigs, lids blinking every frame
+
+    Both modes resample to _PLAYBACK_BONES so the same lid vertices are skinned, per vertex ACTION
+    bones would bind no weights and deform nothing.
+    '''
+    clear_scene()
+    names = []
+    for i in range(heads):
+        rig = setup_rig(_PLAYBACK_SIDE, size, 0, f"head{i}", mode)
+        rig.bone_count = _PLAYBACK_BONES
+        names.append(rig.name)
+    rigs = [bpy.context.scene.lid_rigs[name] for name in names]
+    ui.generate_rigs(bpy.context, rigs)
+    for rig in rigs:
+        armature = ui.get_object(rig.armature, "Armature")
+        modifier = ui.get_object(rig.mesh_object, "Mesh Object").modifiers.new("Armature", 'ARMATURE')
+        modifier.object = armature
+        #close and open the lid over the measured frames
+        ctrl = armature.pose.bones[rig.ctrl_bone]
+        for frame, value in ((1, ui._CTRL_BONE_ACTION_MIN), (frames // 2, ui._CTRL_BONE_ACTION_MAX), (frames, ui._CTRL_BONE_ACTION_MIN)):
+            ctrl.location[1] = value
+            ctrl.keyframe_insert("location", index=1, frame=frame)
+    scene = bpy.context.scene
+    scene.frame_set(1) #first evaluation builds the depsgraph, keep it out of the timing
+    start = time.perf_counter()
+    for frame in range(1, frames + 1):
+        scene.frame_set(frame)
+    seconds = time.perf_counter() - start
+    constraints = sum(len(bone.constraints) for rig in rigs for bone in ui.get_object(rig.armature, "Armature").pose.bones)
+    recorder.add("playback", mode.lower(), seconds / frames, heads=heads, lid=size,
+                 constraints=constraints, bones=_PLAYBACK_BONES, fps=round(frames / seconds, 1))
+
+def make_weighted_object(vert_count: int, group_count: int):
+    '''Mesh object with vertex records spread over group_count DEF groups'''
+    mesh = bpy.data.meshes.new("bench_weights")
+    mesh.vertices.add(vert_count)
+    obj = bpy.data.objects.new(mesh.name, mesh)
+    bpy.context.scene.collection.objects.link(obj)
+    names = [f"DEF-bone_{g}" for g in range(group_count)]
+    for name in names:
+        obj.vertex_groups.new(name=name)
+    #per record dicts for the baseline, interned arrays for assign_weights
+    obj["legacy_vertices"] = [{"index": i, "weight": names[i % group_count]} for i in range(vert_count)]
+    store = eye_bones.vertex_records(obj)
+    store.upsert_many(np.arange(vert_count), np.zeros((vert_count, 3)), [""] * vert_count,
+                      [names[i % group_count] for i in range(vert_count)])
+    store.save()
+    return obj
+
+def bench_assign_weights(recorder, sizes=_WEIGHT_SIZES):
+    '''Times the grouped weight writer against the per vertex loop'''
+    for vert_count, group_count in sizes:
+        clear_scene()
+        obj = make_weighted_object(vert_count, group_count)
+        legacy, _ = timed(legacy_assign_weights, obj, "legacy_vertices")
+        grouped, _ = timed(eye_bones.assign_weights, obj, "vertices")
+        recorder.add("weights", "per_vertex", legacy, verts=vert_count, groups=group_count)
+        recorder.add("weights", "grouped", grouped, verts=vert_count, groups=group_count)
+        #records added one at a time, as the per vertex tools do, saved once at the end
+        seconds, _ = timed(add_vertices, obj, vert_count)
+        recorder.add("weights", "add_vertex", seconds, verts=vert_count)
+
+def add_vertices(obj, vert_count: int):
+    for i in range(vert_count):
+        eye_bones.add_vertex(obj, i, (0, 0, 0), "", "DEF-bone_0")
+    eye_bones.vertex_records(obj).save()
+
+def bench_blend(recorder, path: str):
+    '''Regenerates every lid rig stored in a .blend file, e.g. test.blend'''
+    bpy.ops.wm.open_mainfile(filepath=path)
+    name = os.path.basename(path)
+    rigs = ui.ready_rigs(bpy.context)
+    if not rigs:
+        recorder.add("blend", "generate_rigs", None, file=name, rigs=0)
+        return
+    seconds, _ = timed(ui.generate_rigs, bpy.context, rigs, True)
+    recorder.add("blend", "generate_rigs", seconds, file=name, rigs=len(rigs))
+    seconds, _ = timed(ui.generate_rigs, bpy.context, rigs)
+    recorder.add("blend", "regenerate_noop", seconds, file=name, rigs=len(rigs))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the lid rigging pipeline")
+    parser.add_argument("--output", default="bench_output.json")
+    parser.add_argument("--quick", action="store_true", help="smallest sizes only, for smoke runs")
+    parser.add_argument("--blend", default=os.path.join(_DIR, "test.blend"), help="file with lid rigs to regenerate")
+    args = parser.parse_args(argv)
+
+    pick = (lambda sizes: sizes[:1]) if args.quick else (lambda sizes: sizes)
+    recorder = Recorder()
+    if bpy is None:
+        bench_plan(recorder, pick(_LID_SIZES))
+        write_report(args.output, recorder, None)
+        return
+    ui.register()
+    if args.blend and os.path.exists(args.blend):
+        bench_blend(recorder, args.blend)
+    clear_scene()
+    bench_loop_walk(recorder, pick(_LOOP_SIZES))
+    bench_plan(recorder, pick(_LID_SIZES))
+    #one axis at a time around the base case: lid length, mesh density, armature size
+    for size in pick(_LID_SIZES):
+        bench_add_indicies(recorder, _BASE_SIDE, size)
+        bench_generate(recorder, _BASE_SIDE, size, _BASE_BONES)
+    for side in pick(_GRID_SIDES):
+        bench_add_indicies(recorder, side, _BASE_LID)
+        bench_generate(recorder, side, _BASE_LID, _BASE_BONES)
+        bench_bake(recorder, side, _BASE_LID)
+        bench_detect(recorder, side)
+    for bone_count in pick(_BONE_COUNTS):
+        bench_generate(recorder, _BASE_SIDE, _BASE_LID, bone_count)
+    bench_assign_weights(recorder, pick(_WEIGHT_SIZES))
+    #evaluation cost of the generated rigs, per vertex Action constraints against one B-Bone per lid
+    for heads in pick(_PLAYBACK_HEADS):
+        for mode in ('ACTION', 'BBONE'):
+            bench_playback(recorder, heads, _BASE_LID, mode)
+    clear_scene()
+    write_report(args.output, recorder, bpy.app.version_string)
+
+def write_report(path: str, recorder, blender):
+    '''Writes the records with the versions they were measured on, blender is None outside blender'''
+    report = {
+        "blender": blender,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "records": recorder.records,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{len(recorder.records)} records written to {path}")
+
+if __name__ == "__main__":
+    main(sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else [])
@@ -1,48 +1,28 @@
 import bpy
 import bmesh
+import numpy as np
 from mathutils import Vector
+from .mesh_utils import (csr_adjacency, falloff_weights, geodesic_distances, mesh_coordinates,
+                         mesh_edge_array, walk_bmesh_loop, write_group_weights)
+from .record_store import clear_stores, has_vertex_records, save_stores, vertex_records
 
-class VertexGroups(bpy.types.PropertyGroup):
-    index: bpy.props.IntProperty(name="Index")
-    co: bpy.props.FloatVectorProperty(name="Coordinates", size=3)
-    bone: bpy.props.StringProperty(name="Bone")
-    weight: bpy.props.StringProperty(name="Weight")
+@bpy.app.handlers.persistent
+def clear_vertex_records(*args):
+    '''Drops every cached store, the next access rebuilds it from the loaded file'''
+    clear_stores()
 
-# Function to add a vertex to the collection
+@bpy.app.handlers.persistent
+def save_vertex_records(*args):
+    '''Writes every store with unsaved edits back to its object before the file is saved'''
+    save_stores()
+
+_HANDLERS = (("load_post", clear_vertex_records), ("save_pre", save_vertex_records))
+
+# Function to add a vertex to the collection, saved with the next store.save() or file save
 def add_vertex(obj, index, co, bone="", weight=""):
-    if not hasattr(obj, 'vertices'):
-        raise Valu eError(f"No vertices parameter in {obj.name}")
-    
-    # Initialize the index map if not already done
-    if not hasattr(obj, 'vertex_index_map'):
-        obj.vertex_index_map = {v.index: i for i, v in enumerate(obj.vertices)}
-    
-    if index in obj.vertex_index_map:
-        vertex = obj.vertices[obj.vertex_index_map[index]]
-    else:
-        vertex = obj.vertices.add()
-        obj.vertex_index_map[index] = len(obj.vertices) - 1
-    
-    vertex.index = index
-    vertex.co = co
-    vertex.bone = bone
-    vertex.weight = weight
+    vertex_records(obj).upsert(index, co, bone, weight)
  
 def generate_bones(mesh_obj):
-    #internal method
-    def findConnected(vertex, mesh, visited=None):
-        if visited is None:
-            visited = set()
-        
-        visited.add(vertex.index)  # Store index of the vertex
-        connected_vertices = [vertex]  # Store vertex
-        
-        for edge in vertex.link_edges:
-            linked_vert = edge.other_vert(vertex)
-            if linked_vert.select and linked_vert.index not in visited:
-                connected_vertices.extend(findConnected(linked_vert, mesh, visited))
-        
-        return connected_vertices
     #internal class
     class Vertex:
         def __init__(self, index, vertex_co):
@@ -62,8 +42,8 @@ def generate_bones(mesh_obj):
 
     active_vert = mesh.select_history[-1]
 
-    sortedVerts = findConnected(active_vert, mesh)
-    verts = [Vertex(vert.index, vert.co) for vert in sortedVerts] #store currently selected verts
+    walk = walk_bmesh_loop(active_vert) #follows the edit mesh from the active vertex, no edit mode sync
+    verts = [Vertex(index, Vector(co)) for index, co in zip(walk.order.tolist(), walk.coordinates.tolist())] #store currently selected verts
     
     # Switch to Object Mode
     if bpy.context.mode != 'OBJECT':
@@ -84,9 +64,11 @@ def generate_bones(mesh_obj):
         bone.tail = bone.head + Vector((0, 0, 0.001))  # Adjust the tail position as needed
         vert.bone = bone.name  # Assign bone name to Vertex instance
         vert.weight = f"DEF-{bone.name}"
-    #add verts to the list
-    for vert in verts:
-        add_vertex(mesh_obj, vert.index, vert.co, vert.bone, vert.weight)
+    #add the whole loop to the records in one upsert
+    store = vertex_records(mesh_obj)
+    store.upsert_many([vert.index for vert in verts], [vert.co for vert in verts],
+                      [vert.bone for vert in verts], [vert.weight for vert in verts])
+    store.save()
 
     # Return to initial mesh
     if bpy.context.mode != 'OBJECT':
@@ -95,17 +77,74 @@ def generate_bones(mesh_obj):
     bpy.context.view_layer.objects.active = mesh_obj
     bpy.ops.object.mode_set(mode='EDIT')
 
-def assign_weights(obj, vert_group: str): #assign vertex weight from object
-    if vert_group in obj: #if property exist in object
-        verts = obj[vert_group]
-        if verts and obj:
-            for vert in verts:
-                group_index = obj.vertex_groups.find(vert['weight'])
-                if group_index != -1: #if weight exist
-                    weight = obj.vertex_groups[vert['weight']] #add weight
-                    weight.add([vert['index']], 1, 'REPLACE')
-                    weight.lock_weight = True
+def assign_weights(obj, vert_group: str, create_groups: bool = False, radius: float = 0.0): #assign vertex weight from object
+    if radius > 0: #automatic falloff around each vertex instead of weight 1 on the vertex only
+        return assign_falloff_weights(obj, vert_group, radius, create_groups)
+    if has_vertex_records(obj, vert_group):
+        store = vertex_records(obj, vert_group)
+        if len(store):
+            #bucket vertex indices per interned weight group so each group gets a single add call
+            order = np.argsort(store.weight, kind='stable')
+            ids, starts = np.unique(store.weight[order], return_index=True)
+            groups = {group.name: group for group in obj.vertex_groups} #name to group map built once
+            for name_id, indices in zip(ids.tolist(), np.split(store.index[order], starts[1:])):
+                name = store.names[name_id]
+                weight = groups.get(name)
+                if weight is None: #if weight doesnt exist
+                    if not (create_groups and name.startswith("DEF-")):
+                        continue
+                    weight = obj.vertex_groups.new(name=name)
+                weight.add(indices.tolist(), 1, 'REPLACE') #add weight
+                weight.lock_weight = True
             
+def assign_falloff_weights(obj, vert_group: str, radius: float, create_groups: bool = True):
+    '''Weights every stored vertex's group with a geodesic falloff over the mesh surface
+
+    radius is in object space, only vertices closer than radius along the surface are written.
+    '''
+    if not has_vertex_records(obj, vert_group):
+        return
+    store = vertex_records(obj, vert_group)
+    if not len(store):
+        return
+    sources = store.index.astype(np.int64)
+    names = store.weight_names()
+    groups = {group.name: group for group in obj.vertex_groups}
+    for name in set(names) - groups.keys():
+        if create_groups and name.startswith("DEF-"):
+            groups[name] = obj.vertex_groups.new(name=name)
+
+    mesh = obj.data
+    #the reach of the last run is cleared first, a smaller radius or a moved lid leaves no old weights
+    reach_key = f"{vert_group}_falloff_reach"
+    reach = obj.get(reach_key) or {}
+    every = None
+    for name in set(names) | set(reach.keys()):
+        group = groups.get(name)
+        if group is None:
+            continue
+        if name in reach:
+            group.remove(np.asarray(reach[name]).tolist())
+        else: #no reach recorded, older runs may have written anywhere
+            every = every or list(range(len(mesh.vertices)))
+            group.remove(every)
+
+    offsets, neighbours, lengths = csr_adjacency(mesh_edge_array(mesh), mesh_coordinates(mesh))
+    verts, source, distances = geodesic_distances(offsets, neighbours, lengths, sources, radius)
+    weights = falloff_weights(verts, distances, radius)
+    #records sharing a group are written together, one bulk write per group
+    group_of = np.array([groups[name].index if name in groups else -1 for name in names])[source]
+    written = {}
+    for group in groups.values():
+        mask = group_of == group.index
+        if mask.any():
+            #a vertex reached from several records of the same group gets their sum
+            group_verts, inverse = np.unique(verts[mask], return_inverse=True)
+            write_group_weights(group, group_verts, np.minimum(np.bincount(inverse, weights[mask]), 1.0))
+            group.lock_weight = True
+            written[group.name] = group_verts.astype(np.int32)
+    obj[reach_key] = written
+
 def removeProps(prop):
     if hasattr(bpy.types.Object, prop):
         del bpy.types.Object.vertices
@@ -114,14 +153,16 @@ def removeProps(prop):
             del obj[prop]
             print(f"Property {prop} removed from object {obj.name}")
 prop_name = 'vertices'
-'''            
-bpy.utils.register_class(VertexGroups)
-removeProps(prop_name)
-bpy.types.Object.vertices = bpy.props.CollectionProperty(type=VertexGroups)
-bpy.types.Object.vertex_index_map = {}
-'''
-
-#test call
-mesh_obj = bpy.context.active_object
-#generate_bones(mesh_obj)
-assign_weights(mesh_obj, prop_name)
\ No newline at end of file
+
+def register():
+    #stores rebuild from the file after every load and are written before every save
+    for name, callback in _HANDLERS:
+        handlers = getattr(bpy.app.handlers, name)
+        if callback not in handlers:
+            handlers.append(callback)
+
+def unregister():
+    for name, callback in _HANDLERS:
+        handlers = getattr(bpy.app.handlers, name)
+        if callback in handlers:
+            handlers.remove(callback)
@@ -0,0 +1,73 @@
+#binary lid definition files, shared by the add-on and batch pipelines
+#layout, little endian:
+#  header   magic "VIZLIDS\0", version u16, flags u16, mesh vertex count u32, metadata size u64
+#  metadata utf-8 JSON {"lids": [...]}, one entry per lid rig with its settings, bone names and array specs
+#  arrays   int32 indices and float32 rest coordinates, each 8 byte aligned, offsets relative to the array block
+import json, struct
+import numpy as np
+
+_MAGIC = b"VIZLIDS\0"
+_VERSION = 1
+_HEADER = struct.Struct("<8sHHIQ")
+_ALIGN = 8
+_ARRAYS = (("upper", "<i4", 1), ("lower", "<i4", 1), ("upper_coordinates", "<f4", 3), ("lower_coordinates", "<f4", 3))
+_FIELDS = ("name", "armature", "mesh_object", "mode", "bone_count", "mirror", "bones")
+
+def _aligned(size: int) -> int:
+    return -(-size // _ALIGN) * _ALIGN
+
+def write_lid_file(path: str, vertex_count: int, records):
+    '''Writes lid records of one mesh topology
+
+    Each record is a dict with the _FIELDS settings and the _ARRAYS index and coordinate arrays.
+    '''
+    entries, arrays, offset = [], [], 0
+    for record in records:
+        entry = {field: record[field] for field in _FIELDS}
+        for key, dtype, width in _ARRAYS:
+            array = np.ascontiguousarray(record[key], dtype=dtype).reshape((-1, width) if width > 1 else (-1,))
+            entry[key] = {"offset": offset, "shape": list(array.shape)}
+            arrays.append(array)
+            offset += _aligned(array.nbytes)
+        entries.append(entry)
+    metadata = json.dumps({"lids": entries}).encode()
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, 0, vertex_count, len(metadata)))
+        f.write(metadata)
+        f.write(bytes(_aligned(f.tell()) - f.tell()))
+        for array in arrays:
+            f.write(array.tobytes())
+            f.write(bytes(_aligned(array.nbytes) - array.nbytes))
+
+def read_lid_file(path: str):
+    '''Returns (vertex count, records) with the arrays memory mapped from the file, read only'''
+    with open(path, "rb") as f:
+        head = f.read(_HEADER.size)
+        if len(head) != _HEADER.size or head[:len(_MAGIC)] != _MAGIC:
+            raise ValueError(f"{path} is not a lid definition file")
+        magic, version, flags, vertex_count, metadata_size = _HEADER.unpack(head)
+        if version > _VERSION:
+            raise ValueError(f"{path} has lid format version {version}, this add-on reads up to {_VERSION}")
+        entries = json.loads(f.read(metadata_size))["lids"]
+        f.seek(0, 2)
+        data_offset = _aligned(_HEADER.size + metadata_size)
+        data_size = f.tell() - data_offset
+    data = np.memmap(path, dtype=np.uint8, mode='r', offset=data_offset) if data_size > 0 else np.zeros(0, dtype=np.uint8)
+    for entry in entries:
+        for key, dtype, width in _ARRAYS:
+            spec = entry[key]
+            size = int(np.prod(spec["shape"])) * np.dtype(dtype).itemsize
+            if spec["offset"] + size > len(data):
+                raise ValueError(f"{path} is truncated, lid {entry['name']} {key} is missing")
+            entry[key] = data[spec["offset"]:spec["offset"] + size].view(dtype).reshape(spec["shape"])
+    return vertex_count, entries
+
+def check_lid_records(vertex_count: int, records, target_vertex_count: int):
+    '''Raises ValueError unless the records fit a mesh of target_vertex_count vertices'''
+    if vertex_count != target_vertex_count:
+        raise ValueError(f"Lid definition is for {vertex_count} verts, the mesh has {target_vertex_count}")
+    for record in records:
+        for key in ("upper", "lower"):
+            indices = record[key]
+            if len(indices) and (indices.min() < 0 or indices.max() >= target_vertex_count):
+                raise ValueError(f"Lid {record['name']} {key} indices are out of range")
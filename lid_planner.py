@@ -0,0 +1,286 @@
+#lid rig planning on plain arrays, plans are built, cached and diffed before any bone is touched
+import hashlib, zlib
+import numpy as np
+from .mesh_utils import arc_length_parameters, fit_bezier, interpolation_bindings, resample_chain
+
+_BONE_SCALE = 0.01
+_CTRL_BONE_ACTION_MIN = 0
+_CTRL_BONE_ACTION_MAX = -0.1
+_CTRL_BONE_ACTION_AXIS = 'LOCATION_Y'
+_ACTION_FRAME_START = 0
+_ACTION_FRAME_END = 2
+_ACTION_NAME = 'lid-close'
+_BBONE_MAX_SEGMENTS = 32
+_BBONE_HANDLE_FACTOR = 0.390464 #blender B-Bone handle length per unit of bone length and ease
+_MIRROR_SIDES = {"L": "R", "R": "L", "l": "r", "r": "l", "Left": "Right", "Right": "Left"}
+#every setting that changes generated bones, keys or constraints, part of the rig fingerprint
+_SETTINGS = (_BONE_SCALE, _CTRL_BONE_ACTION_MIN, _CTRL_BONE_ACTION_MAX, _CTRL_BONE_ACTION_AXIS,
+             _ACTION_FRAME_START, _ACTION_FRAME_END, _ACTION_NAME, _BBONE_MAX_SEGMENTS, _BBONE_HANDLE_FACTOR)
+_PLAN_CACHE_SIZE = 64
+
+#plans by input digest, the oldest is dropped past _PLAN_CACHE_SIZE
+_plan_cache = {}
+
+def input_hash(*parts) -> int:
+    '''crc32 of the parts as a signed 32 bit int so it fits an ID-property array'''
+    value = 0
+    for part in parts:
+        value = zlib.crc32(part if isinstance(part, bytes) else str(part).encode(), value)
+    return value - (1 << 32) if value >= (1 << 31) else value
+
+def mirror_side(side: str):
+    '''Opposite side suffix, L for R and R for L'''
+    if side not in _MIRROR_SIDES:
+        raise ValueError(f"Lid rig {side} has no opposite side, name it L or R to mirror it")
+    return _MIRROR_SIDES[side]
+
+def side_name(name: str, side: str):
+    '''Adds the rig suffix to a bone, action or constraint name'''
+    return f"{name}.{side}" if side else name
+
+def lid_bone_names(count: int, bone_name: str, top: bool, side: str = ''):
+    '''Bone names for a lid, top lids get corner bones at both ends'''
+    if not top:
+        names = [f"{bone_name}_{i}" for i in range(count)]
+    else:
+        names = [f"{bone_name}_{i}" for i in range(count-2)] #bone index - 1 corner bone
+        names = [f"corner_{bone_name}_start"] + names + [f"corner_{bone_name}_end"]
+    return [side_name(name, side) for name in names]
+
+def world_coordinates(matrix, coordinates):
+    '''Transforms (N, 3) local coordinates by a 4x4 matrix in one multiply'''
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    matrix = np.asarray(matrix, dtype=float)
+    return coordinates @ matrix[:3, :3].T + matrix[:3, 3]
+
+def paired_by_vertex(mode: str, bone_count: int) -> bool:
+    '''True if each upper lid vertex bone closes onto the lower lid vertex bone of the same position'''
+    return mode == 'ACTION' and not bone_count
+
+class LidPlan():
+    '''Bones of one lid: names, (N, 3) heads and tails, input hashes and the vertex binding'''
+    def __init__(self, indices, names, heads, tails, hashes, binding=None):
+        self.indices = indices #lid vertex indices as stored on the rig
+        self.names = names
+        self.heads = heads
+        self.tails = tails
+        self.hashes = hashes
+        self.binding = binding #(vertex indices, bone position, weight), None when a bone sits on each vertex
+
+class LidRigPlan():
+    '''Every bone, key and constraint setting of one lid rig, computed from indices and coordinates
+
+    Plans are shared through the cache of plan_rig, treat them as read only.
+    '''
+    def __init__(self, side: str, armature: str, mesh_object: str, upper_indices, upper_coordinates,
+                 lower_indices, lower_coordinates, matrix, mode: str = 'ACTION', bone_count: int = 0):
+        self.side = side
+        self.armature = armature
+        self.mesh_object = mesh_object
+        self.mode = mode
+        self.bone_count = bone_count
+        upper_indices = np.asarray(upper_indices, dtype=np.int32)
+        lower_indices = np.asarray(lower_indices, dtype=np.int32)
+        if paired_by_vertex(mode, bone_count) and len(upper_indices)-2 != len(lower_indices):
+            raise ValueError(f"Lid rig {side} needs {len(upper_indices)-2} lower lid verts or a bone count")
+        upper_world = world_coordinates(matrix, upper_coordinates)
+        lower_world = world_coordinates(matrix, lower_coordinates)
+        stored_lower = lower_indices
+        if not paired_by_vertex(mode, bone_count):
+            #walk the lower lid in the same direction as the upper one
+            if np.linalg.norm(lower_world[-1] - upper_world[0]) < np.linalg.norm(lower_world[0] - upper_world[0]):
+                lower_world, lower_indices = lower_world[::-1], lower_indices[::-1]
+        self.lids = []
+        self.bbone = None #B-Bone settings of the upper lid in BBONE mode
+        for indices, stored, coordinates, bone_name, top in ((upper_indices, upper_indices, upper_world, 'upper_lid', True),
+                                                            (lower_indices, stored_lower, lower_world, 'lower_lid', False)):
+            if top and mode == 'BBONE':
+                names, heads, tails = self.bbone_bones(upper_world, lower_world)
+                #the whole upper lid deforms with the B-Bone
+                binding = (indices, np.zeros(len(indices), dtype=np.int64), np.ones(len(indices)))
+            else:
+                heads, binding = coordinates, None
+                if bone_count:
+                    heads, binding = self.resample(indices, coordinates, top)
+                heads = heads.astype(np.float32)
+                tails = heads + np.float32(_BONE_SCALE) * np.array((0, 0, 1), dtype=np.float32) # Adjust the tail position as needed
+                names = lid_bone_names(len(heads), bone_name, top, side)
+            hashes = [input_hash(name, head.tobytes(), tail.tobytes()) for name, head, tail in zip(names, heads, tails)]
+            self.lids.append(LidPlan(stored, names, heads, tails, hashes, binding))
+        upper, lower = self.lids
+        if self.bbone is None:
+            #moving upper bones close onto the lower lid bones
+            self.targets = lower.names
+            self.closed_heads = lower.heads
+        else:
+            upper.hashes[0] = input_hash(upper.hashes[0], sorted(self.bbone.items()))
+        self.moving = upper.names[1:1 + len(self.closed_heads)]
+        corners = upper_world[[0, -1]].astype(np.float32)
+        self.ctrl_bone = side_name('ctrl_lid', side)
+        self.ctrl_head = (corners[0] + corners[1]) / 2 #find mid position for ctrl
+        self.ctrl_tail = self.ctrl_head + (0, 0, _BONE_SCALE/2)
+        self.ctrl_hash = input_hash(self.ctrl_bone, self.ctrl_head.tobytes())
+        self.action_name = side_name(_ACTION_NAME, side)
+        self.constraint = {
+            "name": self.action_name + '-constraint',
+            "transform_channel": _CTRL_BONE_ACTION_AXIS,
+            "target_space": 'LOCAL',
+            "min": _CTRL_BONE_ACTION_MIN,
+            "max": _CTRL_BONE_ACTION_MAX,
+            "frame_start": _ACTION_FRAME_START,
+            "frame_end": _ACTION_FRAME_END,
+        }
+        #moving bones also depend on their closed position and on the constraint settings
+        for i, target in enumerate(self.closed_heads, start=1):
+            upper.hashes[i] = input_hash(upper.hashes[i], target.tobytes(), self.ctrl_bone, self.action_name, _SETTINGS)
+        digest = hashlib.sha1(str((armature, mesh_object, mode, bone_count, self.ctrl_hash, _SETTINGS)).encode())
+        for lid, coordinates in zip(self.lids, (upper_coordinates, lower_coordinates)):
+            digest.update(lid.indices.tobytes())
+            digest.update(np.asarray(coordinates, dtype=np.float32).tobytes()) #weights follow vertex positions even if bones do not
+            digest.update(np.asarray(lid.hashes, dtype=np.int32).tobytes())
+        self.fingerprint = digest.hexdigest()
+
+    def resample(self, indices, coordinates, top: bool):
+        '''Bone heads spread evenly along the lid by arc length and the vertex weights binding to them
+
+        The upper lid gets bone_count moving bones between its two corner bones, the lower lid
+        bone_count bones from end to end, so moving bone i closes onto lower bone i.
+        '''
+        count = self.bone_count
+        params = np.linspace(0, 1, count + 2) if top else np.linspace(0, 1, count) if count > 1 else np.array([0.5])
+        points, bones, weights = interpolation_bindings(arc_length_parameters(coordinates), params)
+        return resample_chain(coordinates, params), (indices[points], bones, weights)
+
+    def bbone_bones(self, upper, lower):
+        '''Corner to corner B-Bone of the upper lid and its two handle bones, returns (names, heads, tails)
+
+        Handles are placed so the B-Bone follows the cubic Bezier fitted to the open lid, their
+        closed positions follow the Bezier fitted through the corners and the lower lid. Handles only
+        give directions, the closed handle lengths are reached by scaling the open ease with the
+        handle bone Y scale, ease_scale holds that scale of the start and end handle.
+        '''
+        opened = fit_bezier(upper)
+        closed = fit_bezier(np.vstack((upper[:1], lower, upper[-1:])))
+        offset = np.array((0, 0, _BONE_SCALE))
+        def handle_heads(curve):
+            #blender aims absolute handles from the start handle head and towards the end handle tail
+            return np.array((2 * curve[0] - curve[1], 2 * curve[3] - curve[2] - offset), dtype=np.float32)
+        names = [side_name(name, self.side) for name in ('upper_lid', 'upper_lid_handle_start', 'upper_lid_handle_end')]
+        handles = handle_heads(opened)
+        heads = np.vstack((opened[:1], handles)).astype(np.float32)
+        tails = np.vstack((opened[3:], handles + offset)).astype(np.float32)
+        self.closed_heads = handle_heads(closed)
+        self.targets = None
+        #the corners do not move, so the bone length behind the ease is the same open and closed
+        length = max(np.linalg.norm(opened[3] - opened[0]), 1e-6) * _BBONE_HANDLE_FACTOR
+        ease = [float(np.linalg.norm(curve[1] - curve[0]) / length) for curve in (opened, closed)]
+        ease_out = [float(np.linalg.norm(curve[3] - curve[2]) / length) for curve in (opened, closed)]
+        self.bbone = {
+            "name": names[0],
+            "start": names[1],
+            "end": names[2],
+            "segments": int(np.clip(self.bone_count or len(upper) - 2, 2, _BBONE_MAX_SEGMENTS)),
+            "ease_in": round(ease[0], 4),
+            "ease_out": round(ease_out[0], 4),
+            "ease_scale": [round(closed / max(opened, 1e-4), 4) for opened, closed in (ease, ease_out)],
+        }
+        return names, heads, tails
+
+    def names(self):
+        return self.lids[0].names + self.lids[1].names + [self.ctrl_bone]
+
+    def state(self) -> dict:
+        '''What a rig stores after generating this plan, the input of the next diff'''
+        return {
+            "bones": [dict(zip(lid.names, lid.hashes)) for lid in self.lids],
+            "ctrl_bone": self.ctrl_bone,
+            "ctrl_hash": self.ctrl_hash,
+            "fingerprint": self.fingerprint,
+        }
+
+    def diff(self, state: dict, existing, force: bool = False):
+        '''Returns (changed, removed) bone names against the state of the last generate
+
+        existing supports "in" with bone names, e.g. the armature bones. force changes every bone.
+        '''
+        changed, removed = set(), set()
+        for lid, old in zip(self.lids, state["bones"]):
+            changed.update(name for name, value in zip(lid.names, lid.hashes) if force or old.get(name) != value or name not in existing)
+            removed.update(set(old) - set(lid.names))
+        if force or state["ctrl_hash"] != self.ctrl_hash or self.ctrl_bone not in existing:
+            changed.add(self.ctrl_bone)
+        if state["ctrl_bone"] and state["ctrl_bone"] != self.ctrl_bone:
+            removed.add(state["ctrl_bone"])
+        return changed, removed - set(self.names())
+
+    def to_dict(self) -> dict:
+        '''JSON ready copy of the plan'''
+        return {
+            "side": self.side,
+            "armature": self.armature,
+            "mesh_object": self.mesh_object,
+            "mode": self.mode,
+            "bone_count": self.bone_count,
+            "lids": [{
+                "indices": lid.indices.tolist(),
+                "names": lid.names,
+                "heads": lid.heads.tolist(),
+                "tails": lid.tails.tolist(),
+                "hashes": lid.hashes,
+                "binding": None if lid.binding is None else [part.tolist() for part in lid.binding],
+            } for lid in self.lids],
+            "bbone": self.bbone,
+            "moving": self.moving,
+            "targets": self.targets,
+            "closed_heads": self.closed_heads.tolist(),
+            "ctrl_bone": self.ctrl_bone,
+            "ctrl_head": self.ctrl_head.tolist(),
+            "ctrl_tail": self.ctrl_tail.tolist(),
+            "ctrl_hash": self.ctrl_hash,
+            "action_name": self.action_name,
+            "constraint": self.constraint,
+            "fingerprint": self.fingerprint,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        '''Plan back from to_dict without recomputing it'''
+        plan = cls.__new__(cls)
+        plan.__dict__.update(data)
+        plan.lids = [LidPlan(
+            np.array(lid["indices"], dtype=np.int32),
+            lid["names"],
+            np.array(lid["heads"], dtype=np.float32).reshape(-1, 3),
+            np.array(lid["tails"], dtype=np.float32).reshape(-1, 3),
+            lid["hashes"],
+            None if lid["binding"] is None else (np.array(lid["binding"][0], dtype=np.int32),
+                                                 np.array(lid["binding"][1], dtype=np.int64),
+                                                 np.array(lid["binding"][2])),
+        ) for lid in data["lids"]]
+        plan.closed_heads = np.array(data["closed_heads"], dtype=np.float32).reshape(-1, 3)
+        plan.ctrl_head = np.array(data["ctrl_head"], dtype=np.float32)
+        plan.ctrl_tail = np.array(data["ctrl_tail"], dtype=np.float32)
+        return plan
+
+def plan_rig(side: str, armature: str, mesh_object: str, upper_indices, upper_coordinates,
+             lower_indices, lower_coordinates, matrix, mode: str = 'ACTION', bone_count: int = 0):
+    '''Returns the LidRigPlan of the inputs, reusing the cached plan when the same inputs were planned before'''
+    arrays = [np.ascontiguousarray(array, dtype=dtype) for array, dtype in (
+        (upper_indices, np.int32), (upper_coordinates, np.float32), (lower_indices, np.int32),
+        (lower_coordinates, np.float32), (matrix, np.float64))]
+    digest = hashlib.sha1(str((side, armature, mesh_object, mode, bone_count, _SETTINGS)).encode())
+    for array in arrays:
+        digest.update(str(array.shape).encode())
+        digest.update(array.tobytes())
+    key = digest.hexdigest()
+    plan = _plan_cache.pop(key, None)
+    if plan is None:
+        plan = LidRigPlan(side, armature, mesh_object, *arrays[:4], arrays[4], mode, bone_count)
+    _plan_cache[key] = plan #most recently used plans stay at the end
+    while len(_plan_cache) > _PLAN_CACHE_SIZE:
+        del _plan_cache[next(iter(_plan_cache))]
+    return plan
+
+def diff_plans(old, new):
+    '''Returns (changed, removed) bone names going from the old plan to the new one'''
+    return new.diff(old.state(), set(old.names()))
@@ -0,0 +1,317 @@
+#bulk mesh access and loop ordering helpers
+import heapq
+import numpy as np
+
+class LoopWalk():
+    '''Ordered chain of selected vertices found from a start vertex'''
+    def __init__(self, order, closed, branches, coordinates=None):
+        self.order = order #mesh vertex indices in walk order, from the start vertex or the chain end nearest it
+        self.closed = closed #True if every walked vertex has exactly two selected neighbours
+        self.branches = branches #mesh vertex indices with more than two selected neighbours
+        self.coordinates = coordinates #(N, 3) coordinates in walk order, if the walker read them
+
+def mesh_edge_array(mesh):
+    '''Returns (E, 2) int array of edge vertex indices'''
+    #read fresh every call, a cache keyed on element counts misses edge rotates and undo
+    edges = np.empty(len(mesh.edges) * 2, dtype=np.int32)
+    mesh.edges.foreach_get("vertices", edges)
+    return edges.reshape(-1, 2)
+
+def mesh_selection(mesh):
+    '''Returns bool array of vertex select flags (call update_from_editmode first in edit mode)'''
+    select = np.empty(len(mesh.vertices), dtype=bool)
+    mesh.vertices.foreach_get("select", select)
+    return select
+
+def mesh_coordinates(mesh):
+    '''Returns (N, 3) float32 array of local vertex coordinates'''
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    return co.reshape(-1, 3)
+
+def chain_from_end(order, degrees, *columns):
+    '''Reorders a depth first walk that started inside an open chain so it runs from end to end
+
+    The walk went from the start to the end of one side, then from the start to the other end, so the
+    first side is reversed in front of the second. Returns the order followed by each reordered column.
+    '''
+    end = next(i for i, degree in enumerate(degrees) if i and degree == 1)
+    chain = list(range(end, -1, -1)) + list(range(end + 1, len(order)))
+    return [np.asarray(column)[chain] for column in (order,) + columns]
+
+def walk_loop(edges, select, start: int) -> LoopWalk:
+    '''Orders selected vertices connected to start without recursion
+
+    edges is an (E, 2) int array, select a bool array with one flag per mesh vertex.
+    Vertices are visited depth first, same order as the old recursive findConnected. A start inside an
+    open chain gives the chain from the end on the side walked first.
+    '''
+    if not select[start]:
+        raise ValueError(f"Start vertex {start} is not selected")
+    #keep only edges with both ends selected and relabel their verts to compact ids
+    sel_edges = edges[select[edges[:, 0]] & select[edges[:, 1]]]
+    verts = np.flatnonzero(select)
+    local = np.searchsorted(verts, sel_edges)
+    count = len(verts)
+    #compact adjacency (CSR) over the selected verts only
+    src = np.concatenate((local[:, 0], local[:, 1]))
+    dst = np.concatenate((local[:, 1], local[:, 0]))
+    dst = dst[np.argsort(src, kind='stable')]
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=count), out=offsets[1:])
+    degree = np.diff(offsets)
+
+    #iterative depth first walk, python lists are faster than numpy for scalar access
+    neighbours = dst.tolist()
+    offsets = offsets.tolist()
+    visited = [False] * count
+    order = []
+    stack = [int(np.searchsorted(verts, start))]
+    while stack:
+        vert = stack.pop()
+        if visited[vert]:
+            continue
+        visited[vert] = True
+        order.append(vert)
+        linked = neighbours[offsets[vert]:offsets[vert + 1]]
+        stack.extend(v for v in reversed(linked) if not visited[v])
+
+    walked = degree[order]
+    closed = len(order) > 2 and bool((walked == 2).all())
+    branches = verts[degree > 2]
+    if not closed and not len(branches) and walked[0] == 2:
+        order, = chain_from_end(order, walked.tolist())
+    order = verts[np.asarray(order, dtype=np.int64)]
+    return LoopWalk(order, closed, branches)
+
+def walk_bmesh_loop(start) -> LoopWalk:
+    '''Orders selected BMesh vertices connected to start by following their link_edges
+
+    Only the walked vertices and their edges are touched, so the cost follows the loop size and not
+    the mesh, and no edit mode sync is needed. Walks depth first like walk_loop, branches lists only
+    walked vertices.
+    '''
+    if not start.select:
+        raise ValueError(f"Start vertex {start.index} is not selected")
+    visited = set()
+    order, coordinates, branches, degrees = [], [], [], []
+    stack = [start]
+    while stack:
+        vert = stack.pop()
+        if vert.index in visited:
+            continue
+        visited.add(vert.index)
+        order.append(vert.index)
+        coordinates.append(vert.co[:])
+        linked = [other for other in (edge.other_vert(vert) for edge in vert.link_edges) if other.select]
+        degrees.append(len(linked))
+        if len(linked) > 2:
+            branches.append(vert.index)
+        stack.extend(other for other in reversed(linked) if other.index not in visited)
+    closed = len(order) > 2 and all(degree == 2 for degree in degrees)
+    order = np.array(order, dtype=np.int64)
+    coordinates = np.array(coordinates, dtype=np.float32).reshape(-1, 3)
+    if not closed and not branches and degrees[0] == 2:
+        order, coordinates = chain_from_end(order, degrees, coordinates)
+    return LoopWalk(order, closed, np.array(branches, dtype=np.int64), coordinates)
+
+def csr_adjacency(edges, coordinates):
+    '''Returns (offsets, neighbours, lengths) CSR arrays of the edge graph weighted by edge length'''
+    count = len(coordinates)
+    src = np.concatenate((edges[:, 0], edges[:, 1]))
+    dst = np.concatenate((edges[:, 1], edges[:, 0]))
+    order = np.argsort(src, kind='stable')
+    src, dst = src[order], dst[order]
+    lengths = np.linalg.norm(coordinates[dst] - coordinates[src], axis=1)
+    offsets = np.zeros(count + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=count), out=offsets[1:])
+    return offsets, dst, lengths
+
+def geodesic_distances(offsets, neighbours, lengths, sources, radius: float):
+    '''Multi-source Dijkstra limited to radius
+
+    Every source gets its own distance field but all of them share one heap, only vertices
+    closer than radius to a source are visited. Returns (vertex, source, distance) arrays where
+    source is the position in sources.
+    '''
+    settled = {}
+    heap = [(0.0, int(vert), i) for i, vert in enumerate(sources)]
+    heapq.heapify(heap)
+    while heap:
+        distance, vert, source = heapq.heappop(heap)
+        if (vert, source) in settled:
+            continue
+        settled[(vert, source)] = distance
+        start, end = offsets[vert], offsets[vert + 1]
+        for linked, length in zip(neighbours[start:end].tolist(), lengths[start:end].tolist()):
+            linked_distance = distance + length
+            if linked_distance < radius and (linked, source) not in settled:
+                heapq.heappush(heap, (linked_distance, linked, source))
+    pairs = np.array(list(settled.keys()), dtype=np.int64).reshape(-1, 2)
+    return pairs[:, 0], pairs[:, 1], np.fromiter(settled.values(), dtype=float, count=len(settled))
+
+def falloff_weights(verts, distances, radius: float, sharpness: float = 2):
+    '''Smooth radius falloff per (vertex, source) pair, normalized per vertex
+
+    Weights of a vertex are shared between its sources by inverse distance ** sharpness and sum
+    to the falloff of the nearest source, so overlapping lid bones do not exceed it.
+    '''
+    t = np.clip(distances / radius, 0, 1)
+    falloff = 1 - t * t * (3 - 2 * t) #smoothstep from 1 at the source to 0 at radius
+    share = falloff / np.maximum(t, 1e-3) ** sharpness
+    total = np.zeros(verts.max() + 1 if len(verts) else 0)
+    nearest = np.zeros_like(total)
+    np.add.at(total, verts, share)
+    np.maximum.at(nearest, verts, falloff)
+    scale = np.divide(nearest, total, out=np.zeros_like(total), where=total > 0)
+    return share * scale[verts]
+
+def write_group_weights(group, indices, weights, step: float = 1 / 256):
+    '''Writes per vertex weights to a vertex group with one add call per quantized weight'''
+    levels = np.round(np.asarray(weights) / step).astype(np.int64)
+    order = np.argsort(levels, kind='stable')
+    levels, indices = levels[order], np.asarray(indices)[order]
+    values, starts = np.unique(levels, return_index=True)
+    for level, chunk in zip(values.tolist(), np.split(indices, starts[1:])):
+        if level > 0:
+            group.add(chunk.tolist(), min(level * step, 1.0), 'REPLACE')
+
+def arc_length_parameters(coordinates):
+    '''Normalized arc length (0 at the first point, 1 at the last) of each point of an ordered chain'''
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    t = np.zeros(len(coordinates))
+    np.cumsum(np.linalg.norm(np.diff(coordinates, axis=0), axis=1), out=t[1:])
+    if not len(t) or t[-1] <= 0:
+        return np.linspace(0, 1, len(t))
+    return t / t[-1]
+
+def resample_chain(coordinates, params):
+    '''Points of an ordered chain at normalized arc length params'''
+    coordinates = np.asarray(coordinates, dtype=float).reshape(-1, 3)
+    t = arc_length_parameters(coordinates)
+    return np.stack([np.interp(params, t, coordinates[:, axis]) for axis in range(3)], axis=1)
+
+def interpolation_bindings(point_params, sample_params):
+    '''Binds each point to its two neighbouring samples by linear interpolation weights
+
+    Both arrays are normalized arc length params, sample_params sorted. Returns (points, samples,
+    weights) arrays with zero weights dropped, weights of a point sum to 1.
+    '''
+    point_params = np.asarray(point_params, dtype=float)
+    sample_params = np.asarray(sample_params, dtype=float)
+    points = np.arange(len(point_params))
+    if len(sample_params) == 1:
+        return points, np.zeros_like(points), np.ones(len(points))
+    left = np.clip(np.searchsorted(sample_params, point_params, side='right') - 1, 0, len(sample_params) - 2)
+    span = sample_params[left + 1] - sample_params[left]
+    w = np.clip((point_params - sample_params[left]) / span, 0, 1)
+    points = np.concatenate((points, points))
+    samples = np.concatenate((left, left + 1))
+    weights = np.concatenate((1 - w, w))
+    keep = weights > 0
+    return points[keep], samples[keep], weights[keep]
+
+def fit_bezier(points):
+    '''Least squares cubic Bezier through the first and last point of an ordered chain
+
+    Points are parameterized by arc length, returns the (4, 3) control points.
+    '''
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    start, end = points[0], points[-1]
+    if len(points) < 3:
+        return np.stack((start, start + (end - start) / 3, end - (end - start) / 3, end))
+    t = arc_length_parameters(points)[:, None]
+    basis = np.hstack((3 * (1 - t) ** 2 * t, 3 * (1 - t) * t ** 2))
+    rhs = points - (1 - t) ** 3 * start - t ** 3 * end
+    handles = np.linalg.lstsq(basis, rhs, rcond=None)[0]
+    return np.stack((start, handles[0], handles[1], end))
+
+def mesh_edge_face_counts(mesh):
+    '''Returns the number of faces using each edge, from one bulk read of loop edge indices'''
+    loop_edges = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get("edge_index", loop_edges)
+    return np.bincount(loop_edges, minlength=len(mesh.edges))
+
+def boundary_loops(edges):
+    '''Orders (E, 2) boundary edges into closed vertex loops, returns a list of index arrays
+
+    Chains that do not close, e.g. through a vertex shared by more than two boundary edges, are dropped.
+    '''
+    if not len(edges):
+        return []
+    src = np.concatenate((edges[:, 0], edges[:, 1]))
+    dst = np.concatenate((edges[:, 1], edges[:, 0]))
+    order = np.argsort(src, kind='stable')
+    src, dst = src[order], dst[order]
+    verts, starts, counts = np.unique(src, return_index=True, return_counts=True)
+    #two boundary neighbours per vertex as compact ids, python lists for the scalar walk
+    first = np.searchsorted(verts, dst[starts]).tolist()
+    second = np.searchsorted(verts, dst[starts + (counts > 1)]).tolist()
+    visited = [False] * len(verts)
+    loops = []
+    for start in range(len(verts)):
+        if visited[start]:
+            continue
+        loop, prev, vert = [start], -1, start
+        visited[start] = True
+        while True:
+            linked = first[vert] if first[vert] != prev else second[vert]
+            if linked == start or visited[linked]:
+                break
+            visited[linked] = True
+            loop.append(linked)
+            prev, vert = vert, linked
+        if linked == start and len(loop) > 2:
+            loops.append(verts[np.asarray(loop, dtype=np.int64)])
+    return loops
+
+def eye_loops(loops, coordinates):
+    '''Picks the eye loop of each side, returns (left, right) with None for a side without one
+
+    Loops crossing the X = 0 centre line (neck, mouth) are skipped, of the rest the highest loop
+    of each side is the eye. +X is the character's left.
+    '''
+    eyes = [None, None]
+    heights = [-np.inf, -np.inf]
+    for loop in loops:
+        x = coordinates[loop, 0]
+        if x.min() > 0:
+            side = 0
+        elif x.max() < 0:
+            side = 1
+        else:
+            continue
+        height = coordinates[loop, 2].mean()
+        if height > heights[side]:
+            eyes[side], heights[side] = loop, height
+    return tuple(eyes)
+
+def split_lid_loop(loop, coordinates):
+    '''Splits a closed eye loop at its X-extreme corners, returns (upper, lower) vertex indices
+
+    Both halves run from one corner to the other, the higher one is the upper lid and keeps both
+    corners, the lower lid gets the vertices between them.
+    '''
+    x = coordinates[loop, 0]
+    i, j = sorted((int(np.argmin(x)), int(np.argmax(x))))
+    first = loop[i:j + 1]
+    second = np.concatenate((loop[j:], loop[:i + 1]))[::-1]
+    if coordinates[first, 2].mean() >= coordinates[second, 2].mean():
+        return first, second[1:-1]
+    return second, first[1:-1]
+
+def barycentric_weights(points, a, b, c):
+    '''Barycentric coordinates of points on triangles (a, b, c), all (N, 3) arrays, returns (N, 3)
+
+    Points off a triangle are clamped onto it, degenerate triangles share the weight evenly.
+    '''
+    v0, v1, v2 = b - a, c - a, points - a
+    d00, d01, d11 = (v0 * v0).sum(1), (v0 * v1).sum(1), (v1 * v1).sum(1)
+    d20, d21 = (v2 * v0).sum(1), (v2 * v1).sum(1)
+    denom = d00 * d11 - d01 * d01
+    degenerate = np.abs(denom) <= 1e-20
+    denom = np.where(degenerate, 1, denom)
+    v = np.where(degenerate, 1 / 3, (d11 * d20 - d01 * d21) / denom)
+    w = np.where(degenerate, 1 / 3, (d00 * d21 - d01 * d20) / denom)
+    weights = np.clip(np.stack((1 - v - w, v, w), axis=1), 0, None)
+    return weights / weights.sum(axis=1, keepdims=True)
@@ -0,0 +1,161 @@
+#per vertex records of eye_bones, interned ID-property arrays indexed by mesh vertex
+import itertools
+import numpy as np
+
+#stores per (object pointer, property), dropped on file load so they rebuild from the ID-properties
+_stores = {}
+_versions = itertools.count(1) #stamp of each save, a store whose stamp differs from the object's is reloaded
+
+class VertexRecords():
+    '''Vertex records of an object, indexed by mesh vertex index
+
+    Saved on the object as parallel ID-property arrays, bone and group names are interned in a table:
+    obj[prop] = {"index": int, "co": 3 floats, "bone": int, "weight": int per record, "names": [str], "version": int}
+    In memory the arrays have spare capacity that doubles when full, so adding records one by one stays linear.
+    Edits only mark the store dirty, save() writes them back, dirty stores are also saved before the file is.
+    '''
+    def __init__(self, obj, prop: str):
+        self.obj, self.prop = obj, prop
+        data = obj.get(prop)
+        if data is None:
+            self.load((), (), (), (), [])
+        elif hasattr(data, "keys"):
+            self.load(data["index"], data["co"], data["bone"], data["weight"], list(data["names"]))
+            self.version = data.get("version", 0)
+        else: #list of dicts written by the former Object.vertices CollectionProperty
+            records = [record.to_dict() if hasattr(record, "to_dict") else record for record in data]
+            self.load((), (), (), (), [])
+            self.upsert_many([record["index"] for record in records],
+                             [record.get("co", (0, 0, 0)) for record in records],
+                             [record.get("bone", "") for record in records],
+                             [record.get("weight", "") for record in records])
+            self.version = -1
+
+    def load(self, index, co, bone, weight, names):
+        self._index = np.array(index, dtype=np.int32)
+        self._co = np.array(co, dtype=np.float32).reshape(-1, 3)
+        self._bone = np.array(bone, dtype=np.int32)
+        self._weight = np.array(weight, dtype=np.int32)
+        self.size = len(self._index)
+        self.names = names
+        self.name_ids = {name: i for i, name in enumerate(names)}
+        self.rows = {vert: row for row, vert in enumerate(self._index.tolist())}
+        self.version = 0
+        self.dirty = False
+
+    #views of the used rows, the buffers behind them are longer
+    index = property(lambda self: self._index[:self.size])
+    co = property(lambda self: self._co[:self.size])
+    bone = property(lambda self: self._bone[:self.size])
+    weight = property(lambda self: self._weight[:self.size])
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, index: int):
+        return index in self.rows
+
+    def reserve(self, size: int):
+        '''Grows the buffers to hold at least size records, doubling the capacity'''
+        capacity = len(self._index)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 16)
+        for name in ("_index", "_co", "_bone", "_weight"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def intern(self, name: str) -> int:
+        '''Id of a name in the table, added if new'''
+        if name not in self.name_ids:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return self.name_ids[name]
+
+    def lookup(self, index: int):
+        '''Returns (co, bone, weight) of a mesh vertex, None if it has no record'''
+        row = self.rows.get(index)
+        if row is None:
+            return None
+        return self.co[row], self.names[self.bone[row]], self.names[self.weight[row]]
+
+    def upsert_many(self, indices, co, bones, weights):
+        '''Adds or replaces the records of many vertices, e.g. a whole lid loop, the last of repeated indices wins'''
+        indices = np.asarray(indices, dtype=np.int32).reshape(-1)
+        co = np.asarray(co, dtype=np.float32).reshape(-1, 3)
+        bones = np.array([self.intern(name) for name in bones], dtype=np.int32)
+        weights = np.array([self.intern(name) for name in weights], dtype=np.int32)
+        rows = np.empty(len(indices), dtype=np.int64)
+        self.reserve(self.size + len(indices))
+        for i, vert in enumerate(indices.tolist()):
+            row = self.rows.get(vert)
+            if row is None:
+                row = self.rows[vert] = self.size
+                self._index[row] = vert
+                self.size += 1
+            rows[i] = row
+        #fancy assignment order is unspecified for repeated rows, so only the last write of each row is kept
+        last = len(rows) - 1 - np.unique(rows[::-1], return_index=True)[1]
+        self._co[rows[last]] = co[last]
+        self._bone[rows[last]] = bones[last]
+        self._weight[rows[last]] = weights[last]
+        self.dirty = True
+
+    def upsert(self, index: int, co, bone: str = "", weight: str = ""):
+        '''Adds or replaces the record of one vertex'''
+        self.upsert_many((index,), (co,), (bone,), (weight,))
+
+    def remove(self, indices):
+        '''Drops the records of the given vertices, the last record fills each freed row'''
+        for vert in np.asarray(indices).reshape(-1).tolist():
+            row = self.rows.pop(vert, None)
+            if row is None:
+                continue
+            last = self.size - 1
+            if row != last:
+                self._index[row], self._co[row] = self._index[last], self._co[last]
+                self._bone[row], self._weight[row] = self._bone[last], self._weight[last]
+                self.rows[int(self._index[row])] = row
+            self.size = last
+            self.dirty = True
+
+    def weight_names(self):
+        '''Group name of each record, in record order'''
+        return [self.names[i] for i in self.weight.tolist()]
+
+    def save(self):
+        '''Writes the records back to the object ID-properties'''
+        self.version = next(_versions)
+        self.obj[self.prop] = {"index": self.index, "co": self.co.ravel(), "bone": self.bone,
+                               "weight": self.weight, "names": self.names, "version": self.version}
+        self.dirty = False
+
+def vertex_records(obj, prop: str = 'vertices') -> VertexRecords:
+    '''Record store of an object, built once and reused until the object data is replaced'''
+    key = (obj.as_pointer(), prop)
+    store = _stores.get(key)
+    data = obj.get(prop)
+    version = data.get("version", 0) if hasattr(data, "keys") else 0 if data is None else -1
+    if store is None or store.version != version:
+        store = _stores[key] = VertexRecords(obj, prop)
+    store.obj = obj #undo can reallocate the object at the same pointer
+    return store
+
+def has_vertex_records(obj, prop: str) -> bool:
+    '''True if obj has saved records under prop or a store with records not saved yet'''
+    return prop in obj or (obj.as_pointer(), prop) in _stores
+
+def clear_stores():
+    '''Drops every cached store, the next access rebuilds it from the object'''
+    _stores.clear()
+
+def save_stores():
+    '''Writes every store with unsaved edits back to its object'''
+    for store in _stores.values():
+        try:
+            if store.dirty:
+                store.save()
+        except ReferenceError: #object was deleted since
+            pass
@@ -0,0 +1,60 @@
+import struct
+import numpy as np
+import pytest
+from ..lid_format import _HEADER, check_lid_records, read_lid_file, write_lid_file
+
+def lid_record(name="Lid.L", upper=(0, 1, 2, 3), lower=(0, 4, 5, 3)):
+    upper, lower = np.array(upper), np.array(lower)
+    return {"name": name, "armature": "metarig", "mesh_object": "Face", "mode": 'ACTION', "bone_count": 4,
+            "mirror": False, "bones": [f"eyeLid_{i}.L" for i in range(4)],
+            "upper": upper, "lower": lower,
+            "upper_coordinates": np.arange(len(upper) * 3, dtype=float).reshape(-1, 3) / 10,
+            "lower_coordinates": -np.arange(len(lower) * 3, dtype=float).reshape(-1, 3) / 10}
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "lids.vlid")
+    records = [lid_record(), lid_record("Lid.R", (6, 7, 8), (6, 9, 8))]
+    write_lid_file(path, 10, records)
+    vertex_count, read = read_lid_file(path)
+    assert vertex_count == 10
+    assert [entry["name"] for entry in read] == ["Lid.L", "Lid.R"]
+    for record, entry in zip(records, read):
+        assert entry["bones"] == record["bones"] and entry["mode"] == record["mode"]
+        for key in ("upper", "lower", "upper_coordinates", "lower_coordinates"):
+            assert isinstance(entry[key].base, np.memmap) #mapped from the file, not copied
+            np.testing.assert_allclose(entry[key], record[key], rtol=1e-6)
+        assert entry["upper"].dtype == np.int32 and entry["upper_coordinates"].shape == (len(record["upper"]), 3)
+
+def test_truncated(tmp_path):
+    path = tmp_path / "lids.vlid"
+    write_lid_file(str(path), 10, [lid_record()])
+    path.write_bytes(path.read_bytes()[:-8])
+    with pytest.raises(ValueError, match="truncated"):
+        read_lid_file(str(path))
+
+def test_newer_version(tmp_path):
+    path = tmp_path / "lids.vlid"
+    write_lid_file(str(path), 10, [lid_record()])
+    data = bytearray(path.read_bytes())
+    struct.pack_into("<H", data, 8, 99) #version follows the 8 byte magic
+    path.write_bytes(bytes(data))
+    with pytest.raises(ValueError, match="version 99"):
+        read_lid_file(str(path))
+
+def test_not_a_lid_file(tmp_path):
+    path = tmp_path / "lids.vlid"
+    path.write_bytes(b"\0" * _HEADER.size)
+    with pytest.raises(ValueError, match="not a lid definition"):
+        read_lid_file(str(path))
+
+def test_check_records(tmp_path):
+    path = str(tmp_path / "lids.vlid")
+    write_lid_file(path, 10, [lid_record()])
+    vertex_count, records = read_lid_file(path)
+    check_lid_records(vertex_count, records, 10)
+    with pytest.raises(ValueError, match="10 verts"):
+        check_lid_records(vertex_count, records, 12)
+    with pytest.raises(ValueError, match="out of range"):
+        check_lid_records(5, records, 5) #lower lid reaches vertex 5, upper stops at 3
+    with pytest.raises(ValueError, match="out of range"):
+        check_lid_records(10, [lid_record(upper=(0, -1, 3))], 10)
@@ -0,0 +1,125 @@
+import json
+import numpy as np
+import pytest
+from .. import lid_planner
+from ..lid_planner import _BBONE_HANDLE_FACTOR, LidRigPlan, diff_plans, mirror_side, plan_rig
+from ..mesh_utils import fit_bezier
+
+def lid_inputs(size: int = 7, reverse_lower: bool = False):
+    '''Upper arc over a flat lower lid, lower lid has size - 2 verts between the corners'''
+    t = np.linspace(0, np.pi, size)
+    upper = np.stack((np.cos(t), np.zeros(size), np.sin(t) * 0.3), axis=1)
+    lower = upper[1:-1] * (1, 1, -0.5)
+    lower_indices = np.arange(size, 2 * size - 2)
+    if reverse_lower:
+        lower, lower_indices = lower[::-1], lower_indices[::-1]
+    return ("L", "rig", "head", np.arange(size), upper, lower_indices, lower, np.eye(4))
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    lid_planner._plan_cache.clear()
+
+def test_per_vertex_plan_pairs_upper_and_lower_bones():
+    plan = plan_rig(*lid_inputs(7))
+    upper, lower = plan.lids
+    assert len(upper.names) == 7 and len(lower.names) == 5
+    assert upper.names[0] == "corner_upper_lid_start.L" and upper.names[-1] == "corner_upper_lid_end.L"
+    assert plan.moving == upper.names[1:-1]
+    assert plan.targets == lower.names
+    assert upper.binding is None and lower.binding is None
+    assert plan.ctrl_bone == "ctrl_lid.L" and plan.action_name == "lid-close.L"
+
+def test_per_vertex_plan_needs_matching_lid_sizes():
+    side, armature, mesh, upper_indices, upper, lower_indices, lower, matrix = lid_inputs(7)
+    with pytest.raises(ValueError):
+        plan_rig(side, armature, mesh, upper_indices, upper, lower_indices[:-1], lower[:-1], matrix)
+
+def test_resampled_plan_binds_lid_vertices_to_bone_budget():
+    plan = plan_rig(*lid_inputs(9), 'ACTION', 3)
+    upper, lower = plan.lids
+    assert len(upper.names) == 5 and len(lower.names) == 3
+    assert len(plan.moving) == len(plan.closed_heads) == 3
+    for lid in plan.lids:
+        indices, bones, weights = lid.binding
+        assert set(indices.tolist()) <= set(lid.indices.tolist())
+        assert bones.max() < len(lid.names) and np.all(weights >= 0)
+        #weights of each vertex sum to one over its bones
+        totals = np.bincount(np.unique(indices, return_inverse=True)[1], weights)
+        np.testing.assert_allclose(totals, 1.0)
+
+def test_resampled_plan_walks_a_reversed_lower_lid_forward():
+    forward = plan_rig(*lid_inputs(9), 'ACTION', 3)
+    reversed_plan = plan_rig(*lid_inputs(9, reverse_lower=True), 'ACTION', 3)
+    np.testing.assert_allclose(forward.closed_heads, reversed_plan.closed_heads, atol=1e-6)
+    #stored indices keep the order they were given in
+    assert reversed_plan.lids[1].indices.tolist() == lid_inputs(9, reverse_lower=True)[5].tolist()
+
+def test_bbone_plan_moves_the_handles():
+    plan = plan_rig(*lid_inputs(9), 'BBONE')
+    upper = plan.lids[0]
+    assert upper.names == ["upper_lid.L", "upper_lid_handle_start.L", "upper_lid_handle_end.L"]
+    assert plan.targets is None
+    assert plan.moving == upper.names[1:]
+    assert plan.bbone["segments"] == 7
+    #the whole upper lid deforms with the B-Bone
+    indices, bones, weights = upper.binding
+    assert indices.tolist() == list(range(9)) and not bones.any() and np.all(weights == 1)
+
+def test_bbone_closed_ease_matches_the_closed_curve():
+    inputs = lid_inputs(9)
+    plan = plan_rig(*inputs, 'BBONE')
+    upper, lower = inputs[4], inputs[6]
+    closed = fit_bezier(np.vstack((upper[:1], lower, upper[-1:])))
+    length = np.linalg.norm(upper[-1] - upper[0]) * _BBONE_HANDLE_FACTOR
+    scale_in, scale_out = plan.bbone["ease_scale"]
+    #blender handle length is ease times handle Y scale times the bone length factor
+    assert plan.bbone["ease_in"] * scale_in * length == pytest.approx(np.linalg.norm(closed[1] - closed[0]), rel=1e-3)
+    assert plan.bbone["ease_out"] * scale_out * length == pytest.approx(np.linalg.norm(closed[3] - closed[2]), rel=1e-3)
+    #the closed lid is flatter, its handles are shorter
+    assert scale_in < 1 and scale_out < 1
+
+def test_plans_are_cached_by_input():
+    inputs = lid_inputs(7)
+    assert plan_rig(*inputs) is plan_rig(*inputs)
+    moved = list(inputs)
+    moved[4] = inputs[4] + (0, 0, 0.01)
+    assert plan_rig(*moved) is not plan_rig(*inputs)
+    assert plan_rig(*moved).fingerprint != plan_rig(*inputs).fingerprint
+
+def test_diff_of_unchanged_plan_is_empty():
+    plan = plan_rig(*lid_inputs(7))
+    assert plan.diff(plan.state(), set(plan.names())) == (set(), set())
+    changed, removed = plan.diff(plan.state(), set(plan.names()), force=True)
+    assert changed == set(plan.names()) and removed == set()
+
+def test_diff_rebuilds_missing_bones_and_moved_lids():
+    plan = plan_rig(*lid_inputs(7))
+    existing = set(plan.names()) - {plan.moving[0]}
+    assert plan.diff(plan.state(), existing) == ({plan.moving[0]}, set())
+    moved = list(lid_inputs(7))
+    moved[6] = moved[6] + (0, 0, -0.01) #lower lid moves, upper bones close onto new targets
+    changed, removed = diff_plans(plan, plan_rig(*moved))
+    assert set(plan.lids[1].names) <= changed and set(plan.moving) <= changed and not removed
+
+def test_diff_removes_bones_of_a_smaller_budget():
+    before = plan_rig(*lid_inputs(9), 'ACTION', 0)
+    after = plan_rig(*lid_inputs(9), 'ACTION', 3)
+    changed, removed = diff_plans(before, after)
+    assert removed == set(before.names()) - set(after.names())
+    assert "upper_lid_3.L" in removed and "lower_lid_6.L" in removed
+
+def test_plan_round_trips_through_json():
+    plan = plan_rig(*lid_inputs(9), 'ACTION', 3)
+    copy = LidRigPlan.from_dict(json.loads(json.dumps(plan.to_dict())))
+    assert copy.fingerprint == plan.fingerprint and copy.names() == plan.names()
+    assert copy.state() == plan.state()
+    for lid, copied in zip(plan.lids, copy.lids):
+        np.testing.assert_allclose(lid.heads, copied.heads)
+        for part, copied_part in zip(lid.binding, copied.binding):
+            np.testing.assert_allclose(part, copied_part)
+    np.testing.assert_allclose(copy.closed_heads, plan.closed_heads)
+
+def test_mirror_side():
+    assert mirror_side("L") == "R" and mirror_side("Left") == "Right"
+    with pytest.raises(ValueError):
+        mirror_side("head")
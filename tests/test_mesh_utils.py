@@ -0,0 +1,146 @@
+import numpy as np
+import pytest
+from ..mesh_utils import (arc_length_parameters, barycentric_weights, boundary_loops, csr_adjacency, eye_loops,
+                          falloff_weights, fit_bezier, geodesic_distances, interpolation_bindings, resample_chain,
+                          split_lid_loop, walk_bmesh_loop, walk_loop, write_group_weights)
+
+class Vert():
+    '''Stand-in for BMVert with the attributes walk_bmesh_loop reads'''
+    def __init__(self, index, select=True):
+        self.index, self.select, self.co, self.link_edges = index, select, (float(index), 0.0, 0.0), []
+
+class Edge():
+    def __init__(self, a, b):
+        self.verts = (a, b)
+        a.link_edges.append(self)
+        b.link_edges.append(self)
+
+    def other_vert(self, vert):
+        return self.verts[1] if vert is self.verts[0] else self.verts[0]
+
+class Group():
+    '''Stand-in for a vertex group recording add calls'''
+    def __init__(self):
+        self.weights, self.calls = {}, 0
+
+    def add(self, indices, weight, mode):
+        self.calls += 1
+        self.weights.update(dict.fromkeys(indices, weight))
+
+def ring(count: int):
+    return np.array([(i, (i + 1) % count) for i in range(count)])
+
+def test_walk_loop_orders_an_open_chain_from_its_end():
+    edges = np.array([(0, 1), (2, 3), (1, 2), (3, 4), (4, 5)])
+    select = np.array([True, True, True, True, True, False])
+    walk = walk_loop(edges, select, 0)
+    assert walk.order.tolist() == [0, 1, 2, 3, 4]
+    assert not walk.closed and not len(walk.branches)
+
+def test_walk_loop_reports_closed_loops_and_branches():
+    walk = walk_loop(ring(5), np.ones(5, dtype=bool), 2)
+    assert walk.closed and sorted(walk.order.tolist()) == list(range(5))
+    branching = np.vstack((ring(4), [(0, 4)]))
+    assert walk_loop(branching, np.ones(5, dtype=bool), 1).branches.tolist() == [0]
+    with pytest.raises(ValueError):
+        walk_loop(ring(4), np.array([False, True, True, True]), 0)
+
+def test_walk_loop_runs_an_open_chain_end_to_end_from_an_inner_start():
+    edges = np.array([(0, 1), (1, 2), (2, 3)])
+    walk = walk_loop(edges, np.ones(4, dtype=bool), 1)
+    assert walk.order.tolist() in ([0, 1, 2, 3], [3, 2, 1, 0])
+    assert not walk.closed
+    #a closed loop with one vertex left out is an open chain, not a loop
+    walk = walk_loop(ring(5), np.array([True] * 4 + [False]), 2)
+    assert walk.order.tolist() in ([0, 1, 2, 3], [3, 2, 1, 0])
+    assert not walk.closed
+
+def test_walk_bmesh_loop_runs_an_open_chain_end_to_end_from_an_inner_start():
+    verts = [Vert(i) for i in range(5)]
+    for a, b in [(0, 1), (1, 2), (2, 3), (3, 4)]:
+        Edge(verts[a], verts[b])
+    walk = walk_bmesh_loop(verts[2])
+    assert walk.order.tolist() in ([0, 1, 2, 3, 4], [4, 3, 2, 1, 0])
+    assert not walk.closed
+    np.testing.assert_array_equal(walk.coordinates[:, 0], walk.order)
+    assert walk_bmesh_loop(verts[0]).order.tolist() == [0, 1, 2, 3, 4]
+
+def test_walk_bmesh_loop_matches_walk_loop():
+    edges = np.vstack((ring(6), [(2, 6)]))
+    select = np.array([True] * 6 + [False])
+    verts = [Vert(i, select[i]) for i in range(7)]
+    for a, b in edges.tolist():
+        Edge(verts[a], verts[b])
+    walk, expected = walk_bmesh_loop(verts[0]), walk_loop(edges, select, 0)
+    assert walk.order.tolist() == expected.order.tolist()
+    assert walk.closed == expected.closed and not len(walk.branches)
+    np.testing.assert_array_equal(walk.coordinates[:, 0], walk.order)
+
+def test_geodesic_distances_follow_edges_within_radius():
+    coordinates = np.array([(i, 0, 0) for i in range(6)], dtype=float)
+    offsets, neighbours, lengths = csr_adjacency(ring(6)[:-1], coordinates)
+    verts, source, distances = geodesic_distances(offsets, neighbours, lengths, np.array([0, 5]), 2.5)
+    found = {(int(v), int(s)): d for v, s, d in zip(verts, source, distances)}
+    assert found == {(0, 0): 0, (1, 0): 1, (2, 0): 2, (5, 1): 0, (4, 1): 1, (3, 1): 2}
+
+def test_falloff_weights_never_exceed_the_nearest_source():
+    verts = np.array([0, 1, 1, 2])
+    distances = np.array([0.0, 0.5, 0.5, 1.0])
+    weights = falloff_weights(verts, distances, 1.0)
+    assert weights[0] == pytest.approx(1.0) and weights[3] == pytest.approx(0.0)
+    assert weights[1] + weights[2] == pytest.approx(0.5) #smoothstep at half radius
+
+def test_write_group_weights_adds_once_per_quantized_weight():
+    group = Group()
+    write_group_weights(group, np.array([3, 4, 5, 6]), np.array([1.0, 0.5, 0.5001, 0.0]))
+    assert group.calls == 2
+    assert group.weights == {3: 1.0, 4: 0.5, 5: 0.5}
+
+def test_arc_length_resampling():
+    chain = np.array([(0, 0, 0), (1, 0, 0), (3, 0, 0)], dtype=float)
+    params = arc_length_parameters(chain)
+    np.testing.assert_allclose(params, [0, 1 / 3, 1])
+    np.testing.assert_allclose(resample_chain(chain, [0, 0.5, 1]), [(0, 0, 0), (1.5, 0, 0), (3, 0, 0)])
+    points, samples, weights = interpolation_bindings(params, np.array([0, 0.5, 1]))
+    np.testing.assert_allclose(np.bincount(points, weights), 1)
+    assert dict(zip(zip(points.tolist(), samples.tolist()), weights.tolist()))[(1, 0)] == pytest.approx(1 / 3)
+
+def bezier(control, t):
+    t = np.asarray(t, dtype=float)[:, None]
+    return ((1 - t) ** 3 * control[0] + 3 * (1 - t) ** 2 * t * control[1]
+            + 3 * (1 - t) * t ** 2 * control[2] + t ** 3 * control[3])
+
+def test_fit_bezier_is_exact_on_an_evenly_spaced_line():
+    control = np.array([(0, 0, 0), (1, 0, 1), (2, 0, 2), (3, 0, 3)], dtype=float)
+    np.testing.assert_allclose(fit_bezier(bezier(control, np.linspace(0, 1, 20))), control, atol=1e-9)
+
+def test_fit_bezier_follows_an_arc():
+    t = np.linspace(0, np.pi, 30)
+    arc = np.stack((np.cos(t), np.zeros_like(t), np.sin(t)), axis=1)
+    fitted = fit_bezier(arc)
+    np.testing.assert_allclose(fitted[[0, 3]], arc[[0, -1]])
+    np.testing.assert_allclose(fitted[1, 2], fitted[2, 2]) #symmetric lid, symmetric handles
+    assert np.abs(bezier(fitted, arc_length_parameters(arc)) - arc).max() < 0.05
+
+def test_boundary_loops_and_eye_split():
+    #two square holes either side of X = 0 and one across it
+    coordinates = np.array([(1, 0, 1), (2, 0, 1), (2, 0, 2), (1, 0, 2),
+                            (-1, 0, 1), (-2, 0, 1), (-2, 0, 2), (-1, 0, 2),
+                            (-1, 0, -1), (1, 0, -1), (1, 0, -2), (-1, 0, -2)], dtype=float)
+    edges = np.vstack([ring(4) + offset for offset in (0, 4, 8)])
+    loops = boundary_loops(edges)
+    assert sorted(sorted(loop.tolist()) for loop in loops) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11]]
+    left, right = eye_loops(loops, coordinates)
+    assert sorted(left.tolist()) == [0, 1, 2, 3] and sorted(right.tolist()) == [4, 5, 6, 7]
+
+def test_split_lid_loop_keeps_corners_on_the_upper_lid():
+    coordinates = np.array([(1, 0, 1), (1.5, 0, 0.5), (2.5, 0, 0.5), (3, 0, 1), (2.5, 0, 1.5), (1.5, 0, 1.5)])
+    upper, lower = split_lid_loop(np.arange(6), coordinates)
+    assert upper.tolist() == [0, 5, 4, 3] and lower.tolist() == [1, 2]
+
+def test_barycentric_weights():
+    a, b, c = (np.array([value], dtype=float) for value in ((0, 0, 0), (1, 0, 0), (0, 1, 0)))
+    np.testing.assert_allclose(barycentric_weights(np.array([(0.25, 0.25, 0)]), a, b, c), [(0.5, 0.25, 0.25)])
+    #points off the triangle clamp onto it, degenerate triangles share evenly
+    np.testing.assert_allclose(barycentric_weights(np.array([(2.0, 0, 0)]), a, b, c), [(0, 1, 0)])
+    np.testing.assert_allclose(barycentric_weights(np.array([(0.0, 0, 0)]), a, a, a), [(1 / 3,) * 3])
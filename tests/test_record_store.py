@@ -0,0 +1,91 @@
+import numpy as np
+from ..record_store import VertexRecords, clear_stores, has_vertex_records, save_stores, vertex_records
+
+class Object(dict):
+    '''Stand-in for bpy.types.Object, ID-properties are dict items'''
+    def as_pointer(self):
+        return id(self)
+
+class Record(dict):
+    '''Stand-in for an item of the former Object.vertices CollectionProperty'''
+    def to_dict(self):
+        return dict(self)
+
+def test_upsert_and_lookup_intern_names():
+    store = VertexRecords(Object(), "vertices")
+    store.upsert_many([4, 7, 9], np.eye(3), ["lid_0", "lid_1", "lid_0"], ["DEF-lid_0", "DEF-lid_1", "DEF-lid_0"])
+    store.upsert(7, (1, 2, 3), "lid_2", "DEF-lid_2")
+    assert len(store) == 3 and 7 in store and 5 not in store
+    co, bone, weight = store.lookup(7)
+    np.testing.assert_array_equal(co, (1, 2, 3))
+    assert (bone, weight) == ("lid_2", "DEF-lid_2")
+    assert store.lookup(5) is None
+    assert store.names == ["lid_0", "lid_1", "DEF-lid_0", "DEF-lid_1", "lid_2", "DEF-lid_2"]
+    assert store.weight_names() == ["DEF-lid_0", "DEF-lid_2", "DEF-lid_0"]
+
+def test_upsert_many_keeps_the_last_of_repeated_indices():
+    store = VertexRecords(Object(), "vertices")
+    store.upsert_many([1, 2, 1, 1], [(0, 0, 0), (2, 2, 2), (1, 1, 1), (3, 3, 3)], ["a", "b", "c", "d"], ["", "", "", ""])
+    assert len(store) == 2 and store.index.tolist() == [1, 2]
+    np.testing.assert_array_equal(store.lookup(1)[0], (3, 3, 3))
+    assert store.lookup(1)[1] == "d"
+
+def test_reserve_doubles_capacity():
+    store = VertexRecords(Object(), "vertices")
+    capacities = set()
+    for i in range(100):
+        store.upsert(i, (i, 0, 0))
+        capacities.add(len(store._index))
+    assert sorted(capacities) == [16, 32, 64, 128]
+    assert len(store) == len(store.index) == len(store.co) == 100
+    np.testing.assert_array_equal(store.co[:, 0], np.arange(100))
+
+def test_remove_fills_the_freed_row_with_the_last_record():
+    store = VertexRecords(Object(), "vertices")
+    store.upsert_many(range(5), np.arange(15).reshape(5, 3), list("abcde"), list("vwxyz"))
+    store.remove([1, 8])
+    assert store.index.tolist() == [0, 4, 2, 3]
+    assert store.rows == {0: 0, 4: 1, 2: 2, 3: 3}
+    assert store.lookup(4)[1:] == ("e", "z") and 1 not in store
+    store.remove([3])
+    assert store.index.tolist() == [0, 4, 2] and store.lookup(2)[1:] == ("c", "x")
+
+def test_save_and_reload_round_trip():
+    obj = Object()
+    store = vertex_records(obj)
+    store.upsert_many([3, 1], [(1, 2, 3), (4, 5, 6)], ["lid_0", "lid_1"], ["DEF-lid_0", "DEF-lid_1"])
+    assert store.dirty and "vertices" not in obj
+    store.save()
+    assert not store.dirty and obj["vertices"]["version"] == store.version
+    loaded = VertexRecords(obj, "vertices")
+    assert loaded.index.tolist() == [3, 1] and loaded.names == store.names
+    np.testing.assert_array_equal(loaded.co, store.co)
+    assert vertex_records(obj) is store #same version, the cached store is reused
+
+def test_vertex_records_keeps_unsaved_edits_and_save_stores_writes_them():
+    clear_stores()
+    obj = Object()
+    vertex_records(obj).upsert(2, (0, 0, 0), "lid_0", "DEF-lid_0")
+    assert has_vertex_records(obj, "vertices") and not has_vertex_records(obj, "other")
+    assert 2 in vertex_records(obj) #not saved yet, the store is not rebuilt
+    save_stores()
+    assert obj["vertices"]["index"].tolist() == [2]
+    clear_stores()
+    assert vertex_records(obj).lookup(2)[2] == "DEF-lid_0"
+
+def test_a_newer_save_on_the_object_rebuilds_the_store():
+    obj = Object()
+    store = vertex_records(obj)
+    store.upsert(1, (0, 0, 0))
+    store.save()
+    other = VertexRecords(obj, "vertices") #e.g. undo restores a different save
+    other.upsert(5, (0, 0, 0))
+    other.save()
+    assert 5 in vertex_records(obj)
+
+def test_legacy_collection_records_are_migrated():
+    obj = Object(vertices=[Record(index=4, co=(1, 0, 0), bone="lid_0", weight="DEF-lid_0"), {"index": 2, "weight": "DEF-lid_1"}])
+    store = VertexRecords(obj, "vertices")
+    assert store.version == -1 and store.index.tolist() == [4, 2]
+    assert store.lookup(4)[1:] == ("lid_0", "DEF-lid_0") and store.lookup(2)[1:] == ("", "DEF-lid_1")
+    assert vertex_records(obj).index.tolist() == [4, 2]
@@ -1,43 +1,249 @@
 #add size to bones based on the mesh size and also generate slide value MAX VALUE
-bl_info = {
-    "name": "Vizor Face Rigging",
-    "blender": (2, 80, 0),
-    "category": "Object",
-}
-
 import bpy, enum, bmesh
-from mathutils import Vector
+import contextlib, cProfile, json, pstats, time
+from bpy_extras.io_utils import ExportHelper, ImportHelper
+from mathutils.bvhtree import BVHTree
+from mathutils.kdtree import KDTree
+import numpy as np
+from .mesh_utils import (barycentric_weights, boundary_loops, eye_loops, mesh_coordinates, mesh_edge_array,
+                         mesh_edge_face_counts, split_lid_loop, walk_bmesh_loop, write_group_weights)
+from .lid_planner import (_ACTION_FRAME_END, _ACTION_FRAME_START, _ACTION_NAME, _CTRL_BONE_ACTION_AXIS,
+                          _CTRL_BONE_ACTION_MAX, _CTRL_BONE_ACTION_MIN, input_hash, mirror_side, paired_by_vertex, plan_rig,
+                          side_name, world_coordinates)
+from .lid_format import check_lid_records, read_lid_file, write_lid_file
+from . import eye_bones
 
-_BONE_SCALE = 0.01 
-_CTRL_BONE_ACTION_MIN = 0
-_CTRL_BONE_ACTION_MAX = -0.1
-_CTRL_BONE_ACTION_AXIS = 'LOCATION_Y'
-_ACTION_FRAME_START = 0
-_ACTION_FRAME_END = 2
-_ACTION_NAME = 'lid-close'
+_CHUNK_SECONDS = 0.05 #work done per timer event of the modal generate, keeps the UI responsive
+_JOURNAL_VERTICES = 20000 #vertices read per step when the journal saves a whole vertex group
+_GENERATE_STAGES = ("plan", "bones", "actions", "weights")
+_PROFILE_EXTENSIONS = {'JSON': ".json", 'PSTATS': ".prof"} #export file extension per profile format
+_MIRROR_TOLERANCE = 1e-4 #largest distance in object space between a vertex and its X-flipped twin
+_MESH_CACHE_SIZE = 8 #meshes whose lookup structures are kept between calls
+_TRANSFER_DISTANCE = 0.01 #farthest a secondary mesh vertex may be from the lid surface to get its weights
 
-class Lid():
-    def __init__(self):
-        self.indices = []
-        self.coordinates = []
-        self.bones = []
+class Lid(bpy.types.PropertyGroup):
+    '''Lid vertex loop of a scene, kept as ID-property arrays so it is compact and saved in the .blend'''
+
+    @property
+    def indices(self):
+        #ID-property arrays expose the buffer protocol, numpy reads them in one copy
+        return np.array(self.get("indices", ()), dtype=np.int32)
+
+    @indices.setter
+    def indices(self, value):
+        self["indices"] = np.asarray(value, dtype=np.int32)
+
+    @property
+    def coordinates(self):
+        '''(N, 3) local vertex coordinates'''
+        return np.array(self.get("coordinates", ()), dtype=np.float32).reshape(-1, 3)
+
+    @coordinates.setter
+    def coordinates(self, value):
+        self["coordinates"] = np.asarray(value, dtype=np.float32).reshape(-1)
+
+    @property
+    def bones(self):
+        return list(self.get("bones", ()))
+
+    @bones.setter
+    def bones(self, value):
+        self["bones"] = list(value)
+
+    @property
+    def hashes(self):
+        '''Input hash of each generated bone, same order as bones'''
+        return np.array(self.get("hashes", ()), dtype=np.int32)
+
+    @hashes.setter
+    def hashes(self, value):
+        self["hashes"] = np.asarray(value, dtype=np.int32)
+
+    @property
+    def bound(self):
+        '''Vertex indices whose weights the last generate wrote to the bone groups of this lid'''
+        return np.array(self.get("bound", ()), dtype=np.int32)
+
+    @bound.setter
+    def bound(self, value):
+        self["bound"] = np.asarray(value, dtype=np.int32)
+
+class LidRig(bpy.types.PropertyGroup):
+    '''One eye: upper and lower lid loops with the objects and names used to rig them'''
+    #name is used as bone, action and constraint suffix, e.g. "L" gives upper_lid_0.L
+    armature: bpy.props.StringProperty(name="Armature")
+    mesh_object: bpy.props.StringProperty(name="Mesh object")
+    ctrl_bone: bpy.props.StringProperty(name="Action Controller bone")
+    #0 keeps one bone per vertex, otherwise lids are resampled to this many moving bones
+    bone_count: bpy.props.IntProperty(name="Bones", description="Moving bones per lid, 0 for one bone per vertex", default=0, min=0)
+    mode: bpy.props.EnumProperty(
+        items=[
+            ("ACTION", "Action constraints", "Every moving lid bone has its own Action constraint"),
+            ("BBONE", "B-Bone", "One B-Bone per upper lid, shaped by two handle bones with an Action constraint each"),
+        ],
+        name="Mode",
+        default="ACTION",
+    )
+    upper: bpy.props.PointerProperty(type=Lid)
+    lower: bpy.props.PointerProperty(type=Lid)
+    #inputs of the last generate, lets regenerate skip unchanged rigs and bones
+    fingerprint: bpy.props.StringProperty(name="Fingerprint")
+    ctrl_hash: bpy.props.IntProperty(name="Controller hash")
+    mirror: bpy.props.BoolProperty(name="Mirror", description="Generate the opposite side rig from the X-mirrored lid vertices", default=False)
+
+    def paired_by_vertex(self) -> bool:
+        '''True if each upper lid vertex bone closes onto the lower lid vertex bone of the same position'''
+        return paired_by_vertex(self.mode, self.bone_count)
 
 class Lid_Layers(enum.IntEnum):
     TOP = 0
     BOTTOM = 1
 
-def findConnected(vertex, mesh, visited=None):
-    if visited is None:
-        visited = set()
-    
-    visited.add(vertex.index)  # Store index of the vertex
-    connected_vertices = [vertex]  # Store Active vertex
-    
-    for edge in vertex.link_edges:
-        linked_vert = edge.other_vert(vertex)
-        if linked_vert.select and linked_vert.index not in visited:
-            connected_vertices.extend(findConnected(linked_vert, mesh, visited))
-    return connected_vertices
+def find_connected(active_vert):
+    '''Returns the walk of the selected loop starting at the active BMesh vertex'''
+    walk = walk_bmesh_loop(active_vert)
+    if len(walk.branches):
+        raise ValueError(f"Selection branches at verts {walk.branches.tolist()}, select a single loop")
+    if walk.closed:
+        raise ValueError("Selection is a closed loop, a lid runs from corner to corner, leave one edge unselected")
+    #bones are built and paired in walk order, it has to start at a lid corner
+    if walk.order[0] != active_vert.index:
+        raise ValueError(f"Active vertex {active_vert.index} is inside the lid, make a corner vertex active")
+    return walk
+
+#mirror lookups per mesh pointer, rebuilt when the coordinates change, the oldest dropped past _MESH_CACHE_SIZE
+_mirror_cache = {}
+
+def mirror_indices(mesh, indices, tolerance: float = _MIRROR_TOLERANCE):
+    '''Maps vertex indices to the vertex at their X-flipped position, -1 where there is none
+
+    The KD-tree over X-flipped coordinates is built once per mesh and every vertex looked up is
+    remembered, both until the vertex coordinates change.
+    '''
+    co = mesh_coordinates(mesh)
+    #the map depends on coordinates only, hashing them catches edits, undo and reused pointers
+    key = (len(co), input_hash(co.tobytes()))
+    cached = _mirror_cache.pop(mesh.as_pointer(), None)
+    if cached is None or cached[0] != key:
+        tree = KDTree(len(co))
+        for i, flipped in enumerate((co * (-1, 1, 1)).tolist()):
+            tree.insert(flipped, i)
+        tree.balance()
+        cached = (key, tree, np.full(len(co), -2, dtype=np.int64)) #-2 not looked up yet
+    _mirror_cache[mesh.as_pointer()] = cached #most recently used meshes stay at the end
+    while len(_mirror_cache) > _MESH_CACHE_SIZE:
+        del _mirror_cache[next(iter(_mirror_cache))]
+    key, tree, mirror = cached
+    indices = np.asarray(indices, dtype=np.int64)
+    missing = np.unique(indices[mirror[indices] == -2])
+    for i, point in zip(missing.tolist(), co[missing].tolist()):
+        found, j, distance = tree.find(point)
+        mirror[i] = j if distance <= tolerance else -1
+    return mirror[indices]
+
+def place_edit_bone(armature, bones: dict, name: str, head, tail):
+    '''Reuses the edit bone called name or creates it, returns the bone name'''
+    bone = bones.get(name)
+    if bone is None:
+        bone = armature.edit_bones.new(name=name)
+        bones[bone.name] = bone
+    else:
+        #reset existing bone instead of removing it, removal searches the bone list each time
+        bone.parent = None
+        bone.use_connect = False
+        bone.roll = 0
+    bone.head = head
+    bone.tail = tail
+    return bone.name
+
+def rest_matrices(obj):
+    '''Returns (N, 4, 4) rest matrices of all bones and a name to row index'''
+    armature_bones = obj.data.bones
+    rest = np.empty(len(armature_bones) * 16, dtype=np.float32)
+    armature_bones.foreach_get("matrix_local", rest)
+    rest = rest.reshape(-1, 4, 4).transpose(0, 2, 1) #matrices are stored column major
+    return rest, {name: i for i, name in enumerate(armature_bones.keys())}
+
+def closed_pose_offsets(obj, rest, index: dict, bones, targets):
+    '''Local location that moves each bone onto its target bone, computed from rest matrices
+
+    Same result as assigning pose_bone.matrix = matrix_world @ target.matrix for unparented bones
+    at rest, without posing or evaluating the armature.
+    '''
+    source = rest[[index[name] for name in bones]]
+    target = np.array(obj.matrix_world) @ rest[[index[name] for name in targets]]
+    return (np.linalg.inv(source) @ target)[:, :3, 3]
+
+def closed_point_offsets(obj, rest, index: dict, bones, points):
+    '''Local location that moves each bone head onto its closed point, same space as closed_pose_offsets'''
+    source = rest[[index[name] for name in bones]]
+    target = np.hstack((np.asarray(points, dtype=float), np.ones((len(points), 1)))) @ np.array(obj.matrix_world).T
+    return np.einsum('nij,nj->ni', np.linalg.inv(source), target)[:, :3]
+
+def configure_bbone(bones: dict, settings: dict):
+    '''Turns an edit bone into a segmented B-Bone shaped by two custom handle bones'''
+    bone = bones[settings["name"]]
+    bone.bbone_segments = settings["segments"]
+    bone.bbone_handle_type_start = 'ABSOLUTE'
+    bone.bbone_handle_type_end = 'ABSOLUTE'
+    bone.bbone_custom_handle_start = bones[settings["start"]]
+    bone.bbone_custom_handle_end = bones[settings["end"]]
+    bone.bbone_easein = settings["ease_in"]
+    bone.bbone_easeout = settings["ease_out"]
+    #handle Y scale multiplies the ease, the action keys it to the closed curve handle lengths
+    bone.bbone_handle_use_ease_start = True
+    bone.bbone_handle_use_ease_end = True
+    #handles only shape the curve, the B-Bone deforms the lid
+    bones[settings["start"]].use_deform = False
+    bones[settings["end"]].use_deform = False
+
+def add_action_constraint(obj, bone: str, ctrl_bone: str, action, settings: dict):
+    '''add constraint and set parameters from the constraint settings of a plan'''
+    # Define source and target bones
+    pbone = obj.pose.bones.get(bone)
+    ctrl_pose_bone = obj.pose.bones.get(ctrl_bone)
+
+    if not pbone or not ctrl_pose_bone:
+        raise ValueError(f"Bones {bone} or {ctrl_bone} dont exist!")
+
+    #check if bone has constraint 'lid-action' and remove it
+    if pbone.constraints:
+        for constraint in [c for c in pbone.constraints if c.type == 'ACTION' and c.name == settings["name"]]:
+            pbone.constraints.remove(constraint)
+
+    #add constraint to the list
+    constraint = pbone.constraints.new(type='ACTION')
+    constraint.target = obj
+    constraint.subtarget = ctrl_bone
+    constraint.action = action
+    for key, value in settings.items():
+        setattr(constraint, key, value)
+
+def write_location_keys(action, bones, offsets, journal=None):
+    '''Keys location at rest on _ACTION_FRAME_START and at offset on _ACTION_FRAME_END for each bone'''
+    co = np.zeros(4, dtype=np.float32)
+    co[0::2] = (_ACTION_FRAME_START, _ACTION_FRAME_END)
+    for name, offset in zip(bones, offsets.tolist()):
+        data_path = f'pose.bones["{bpy.utils.escape_identifier(name)}"].location'
+        for axis in range(3):
+            if journal:
+                journal.save_fcurve(action, data_path, axis)
+            fcurve = action.fcurves.new(data_path, index=axis, action_group=name)
+            fcurve.keyframe_points.add(2)
+            co[3] = offset[axis]
+            fcurve.keyframe_points.foreach_set("co", co)
+            fcurve.update() #sort keys and recalculate handles
+
+def write_scale_keys(action, bones, scales, journal=None):
+    '''Keys Y scale 1 on _ACTION_FRAME_START and scale on _ACTION_FRAME_END for each bone'''
+    for name, scale in zip(bones, scales):
+        data_path = f'pose.bones["{bpy.utils.escape_identifier(name)}"].scale'
+        if journal:
+            journal.save_fcurve(action, data_path, 1)
+        fcurve = action.fcurves.new(data_path, index=1, action_group=name)
+        fcurve.keyframe_points.add(2)
+        fcurve.keyframe_points.foreach_set("co", (_ACTION_FRAME_START, 1, _ACTION_FRAME_END, scale))
+        fcurve.update()
 
 class VIEW3D_OT_vizor_add_remove_lid(bpy.types.Operator):
     bl_idname = "object.vizor_add_lid"
@@ -55,67 +261,70 @@ class VIEW3D_OT_vizor_add_remove_lid(bpy.types.Operator):
     add: bpy.props.BoolProperty(default=True)
 
     
+    def get_rig(self, context):
+        if not 0 <= self.lidIndex < len(context.scene.lid_rigs):
+            raise ValueError(f"Lid rig {self.lidIndex} doesnt exist!")
+        return context.scene.lid_rigs[self.lidIndex]
+
     def add_indicies(self, context):
         assert bpy.context.mode == 'EDIT_MESH' # Ensure we are in Edit Mode
+        rig = self.get_rig(context)
         mesh_obj = context.active_object
         mesh = bmesh.from_edit_mesh(mesh_obj.data)
-        selected_verts = [v for v in mesh.verts if v.select]
+        #edit mesh keeps the selected count, no need to scan every vertex
+        selected_count = mesh_obj.data.total_vert_sel
         #Top Eyelid must have at least 3 verts selected (two for corners and n-amount for bone action rig)
-        if self.lidLayer in ["TOP", "Top"] and len(selected_verts) < 3:
+        if self.lidLayer in ["TOP", "Top"] and selected_count < 3:
             raise ValueError("Please select at least 3 verts!")
-        #top lid selection -2 should be euqual to bottom selection
-        if len(context.scene.upper_lid.indices) or len(context.scene.lower_lid.indices):
-            match self.lidLayer:
+        #top lid selection -2 should be euqual to bottom selection, resampled lids pair any sizes
+        if len(rig.upper.indices) or len(rig.lower.indices):
+            if rig.mesh_object and rig.mesh_object != mesh_obj.name:
+                raise ValueError(f"Lid rig {rig.name} is already bound to {rig.mesh_object}")
+            match self.lidLayer if rig.paired_by_vertex() else None:
                 case 'BOTTOM':
-                    top_lid_size = len(context.scene.upper_lid.indices)-2
-                    if top_lid_size != len(selected_verts):
-                        raise ValueError(f"Please select {top_lid_size-(len(selected_verts))} more vertices")
+                    top_lid_size = len(rig.upper.indices)-2
+                    if top_lid_size != selected_count:
+                        raise ValueError(f"Please select {top_lid_size-selected_count} more vertices")
                 case 'TOP':
-                    low_lid_size = len(context.scene.lower_lid.indices)
-                    if low_lid_size != len(selected_verts)-2:
-                        raise ValueError(f"Please select {low_lid_size-(len(selected_verts)-2)} more vertices")
+                    low_lid_size = len(rig.lower.indices)
+                    if low_lid_size != selected_count-2:
+                        raise ValueError(f"Please select {low_lid_size-(selected_count-2)} more vertices")
         # Check if there's an active vertex
-        if not mesh.select_history:
+        if not mesh.select_history or not isinstance(mesh.select_history[-1], bmesh.types.BMVert):
             raise ValueError("No Active Vertex selected")
         active_vert = mesh.select_history[-1]
-        #starting from active vertex sort list of selected verticies
-        sortedVerts = findConnected(active_vert, mesh)
-        #store indices
-        indicies = [vert.index for vert in sortedVerts]
         match self.lidLayer:
             case 'TOP':
-                #if lower indx list exist check if they have common indx
-                if context.scene.lower_lid.indices:
-                    common = set(indicies) & set(context.scene.lower_lid.indices)
-                    if common:
-                        raise ValueError(f"Top and Bottom lid have common verts{common}")
-                #add top lid indicies
-                context.scene.upper_lid.indices = indicies
-                context.scene.upper_lid.coordinates = [vert.co.copy() for vert in sortedVerts]
-                context.scene.lid_object = mesh_obj.name
+                lid, other_lid = rig.upper, rig.lower
             case 'BOTTOM':
-                #if upper indx list exist check if they have common indx
-                if context.scene.upper_lid.indices:
-                    common = set(indicies) & set(context.scene.upper_lid.indices)
-                    if common:
-                        raise ValueError(f"Top and Bottom lid have common verts{common}")
-                #add bottom lid indicies
-                context.scene.lower_lid.indices = indicies
-                context.scene.lower_lid.coordinates = [vert.co.copy() for vert in sortedVerts]
-                context.scene.lid_object = mesh_obj.name
+                lid, other_lid = rig.lower, rig.upper
+        #starting from active vertex sort list of selected verticies, walks the edit mesh so the
+        #cost follows the lid size, no edit mode sync or per vertex scan of the mesh
+        walk = find_connected(active_vert)
+        indicies = walk.order
+        if len(indicies) != selected_count:
+            raise ValueError(f"{selected_count - len(indicies)} selected verts are not connected to the active vertex")
+        common = np.intersect1d(other_lid.indices, indicies)
+        if len(common):
+            raise ValueError(f"Top and Bottom lid have common verts {common.tolist()}")
+        #store indices
+        lid.indices = indicies
+        lid.coordinates = walk.coordinates
+        rig.mesh_object = mesh_obj.name
     
     def remove_indicies(self,context):
+        rig = self.get_rig(context)
         match self.lidLayer:
             case 'TOP':
                 #remove top lid indicies
-                context.scene.upper_lid.indices = []
-                context.scene.upper_lid.coordinates = []
-                context.scene.lid_object = ''
+                lid, other_lid = rig.upper, rig.lower
             case 'BOTTOM':
                 #remove bottom lid indicies
-                context.scene.lower_lid.indices = []
-                context.scene.lower_lid.coordinates = []
-                context.scene.lid_object = ''
+                lid, other_lid = rig.lower, rig.upper
+        lid.indices = []
+        lid.coordinates = []
+        if not len(other_lid.indices):
+            rig.mesh_object = ''
     
     def execute(self, context):
         match self.add:
@@ -130,231 +339,1233 @@ class VIEW3D_OT_vizor_add_remove_lid(bpy.types.Operator):
 
         return {'FINISHED'}
 
-class VIEW3D_OT_vizor_generate_lid_rig(bpy.types.Operator):
-    bl_idname = "object.vizor_generate_lid_rig"
-    bl_label = "Operator to rig lid"
+def set_rig_lids(rig, mesh_obj, upper, lower):
+    '''Stores ordered upper and lower lid indices on a rig, coordinates are read from mesh_obj'''
+    upper = np.asarray(upper, dtype=np.int64)
+    lower = np.asarray(lower, dtype=np.int64)
+    vertex_count = len(mesh_obj.data.vertices)
+    if len(upper) < 3:
+        raise ValueError("Upper lid needs at least 3 verts!")
+    if rig.paired_by_vertex() and len(upper)-2 != len(lower):
+        raise ValueError(f"Lower lid needs {len(upper)-2} verts, got {len(lower)}")
+    if not len(lower):
+        raise ValueError("Lower lid needs at least 1 vert!")
+    for indices in (upper, lower):
+        if indices.min() < 0 or indices.max() >= vertex_count:
+            raise ValueError(f"Lid indices out of range for {mesh_obj.name} ({vertex_count} verts)")
+    if len(np.intersect1d(upper, lower)):
+        raise ValueError(f"Top and Bottom lid have common verts {np.intersect1d(upper, lower).tolist()}")
+    coordinates = mesh_coordinates(mesh_obj.data)
+    rig.upper.indices, rig.upper.coordinates = upper, coordinates[upper]
+    rig.lower.indices, rig.lower.coordinates = lower, coordinates[lower]
+    rig.mesh_object = mesh_obj.name
+
+def mirror_rig(context, rig):
+    '''Creates or updates the opposite side rig with the lid indices mapped across X, returns its name'''
+    name = mirror_side(rig.name)
+    if rig.armature and (rig.armature, name) in [(other.armature, other.name) for other in context.scene.lid_rigs if other.mirror]:
+        raise ValueError(f"Lid rigs {rig.name} and {name} both mirror to each other")
+    mesh_obj = get_object(rig.mesh_object, "Mesh Object")
+    upper, lower = rig.upper.indices, rig.lower.indices
+    mirrored = mirror_indices(mesh_obj.data, np.concatenate((upper, lower)))
+    if (mirrored < 0).any():
+        raise ValueError(f"{int((mirrored < 0).sum())} lid verts have no mirror vertex on {mesh_obj.name}")
+    settings = (rig.armature, rig.mode, rig.bone_count)
+    rigs = context.scene.lid_rigs
+    index = rigs.find(name)
+    if index == -1:
+        rigs.add().name = name #adding to a collection can move its items, rig is not used after this
+        index = len(rigs) - 1
+    other = rigs[index]
+    other.armature, other.mode, other.bone_count = settings
+    other.mirror = False
+    set_rig_lids(other, mesh_obj, mirrored[:len(upper)], mirrored[len(upper):])
+    return name
+
+def detect_rig_lids(context, mesh_obj, armature: str):
+    '''Finds the eye holes of mesh_obj and fills the L and R rigs with their lids, returns the rig names
+
+    Eye holes are boundary loops, edges used by a single face, found from one bulk read of the
+    mesh. Rigs whose lids do not pair vertex by vertex get a bone count so they can generate.
+    '''
+    mesh = mesh_obj.data
+    with profile_stage("detect_lids", len(mesh.polygons)):
+        coordinates = mesh_coordinates(mesh)
+        boundary = mesh_edge_array(mesh)[mesh_edge_face_counts(mesh) == 1]
+        eyes = eye_loops(boundary_loops(boundary), coordinates)
+    names = []
+    for side, loop in zip(("L", "R"), eyes):
+        if loop is None:
+            continue
+        upper, lower = split_lid_loop(loop, coordinates)
+        rigs = context.scene.lid_rigs
+        if rigs.find(side) == -1:
+            rigs.add().name = side
+        rig = rigs[rigs.find(side)]
+        rig.armature = rig.armature or armature
+        rig.mirror = False #both sides come from the mesh
+        if rig.paired_by_vertex() and len(upper)-2 != len(lower):
+            rig.bone_count = max(1, min(len(upper)-2, len(lower)))
+        set_rig_lids(rig, mesh_obj, upper, lower)
+        names.append(side)
+    if not names:
+        raise ValueError(f"No eye holes found on {mesh_obj.name}, lids need boundary loops off the X = 0 centre line")
+    return names
+
+def export_lid_definition(path: str, rigs):
+    '''Writes the lids, settings and bone names of rigs bound to one mesh to a lid definition file'''
+    rigs = [rig for rig in rigs if len(rig.upper.indices) and len(rig.lower.indices)]
+    if not rigs:
+        raise ValueError("No lid rig has both lids set")
+    meshes = {rig.mesh_object for rig in rigs}
+    if len(meshes) > 1:
+        raise ValueError(f"Lid rigs are bound to several meshes {sorted(meshes)}, export one mesh at a time")
+    mesh_obj = get_object(rigs[0].mesh_object, "Mesh Object")
+    records = [{
+        "name": rig.name,
+        "armature": rig.armature,
+        "mesh_object": rig.mesh_object,
+        "mode": rig.mode,
+        "bone_count": rig.bone_count,
+        "mirror": rig.mirror,
+        "bones": {"upper": rig.upper.bones, "lower": rig.lower.bones, "ctrl": rig.ctrl_bone},
+        "upper": rig.upper.indices,
+        "lower": rig.lower.indices,
+        "upper_coordinates": rig.upper.coordinates,
+        "lower_coordinates": rig.lower.coordinates,
+    } for rig in rigs]
+    write_lid_file(path, len(mesh_obj.data.vertices), records)
+    return len(records)
+
+def import_lid_definition(context, path: str, mesh_obj=None, armature: str = ''):
+    '''Fills rigs from a lid definition file, returns their names
+
+    mesh_obj and armature replace the objects named in the file, so one definition rigs every
+    head of the same topology. Coordinates are read from the target mesh, not from the file.
+    '''
+    vertex_count, records = read_lid_file(path)
+    for record in records:
+        target = mesh_obj or get_object(record["mesh_object"], "Mesh Object")
+        check_lid_records(vertex_count, [record], len(target.data.vertices))
+    names = []
+    for record in records:
+        rigs = context.scene.lid_rigs
+        if rigs.find(record["name"]) == -1:
+            rigs.add().name = record["name"]
+        rig = rigs[rigs.find(record["name"])]
+        rig.armature = armature or record["armature"]
+        rig.mode = record["mode"]
+        rig.bone_count = record["bone_count"]
+        rig.mirror = record["mirror"]
+        set_rig_lids(rig, mesh_obj or get_object(record["mesh_object"], "Mesh Object"), record["upper"], record["lower"])
+        names.append(record["name"])
+    return names
+
+def get_object(name: str, kind: str):
+    obj = bpy.data.objects.get(name)
+    if not obj:
+        raise ValueError(f"{kind} {name} doesnt exist!")
+    return obj
+
+class Profiler():
+    '''Timings of one generate run: stages, bones touched, mode switches and depsgraph updates'''
+    def __init__(self, use_cprofile: bool = False):
+        self.stages = []
+        self.mode_switches = 0
+        self.depsgraph_updates = 0
+        self.total = 0.0
+        self.cprofile = cProfile.Profile() if use_cprofile else None
+
+    @contextlib.contextmanager
+    def stage(self, name: str, bones: int = 0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({"name": name, "seconds": time.perf_counter() - start, "bones": bones})
+
+    def depsgraph_update(self, scene, depsgraph):
+        self.depsgraph_updates += 1
+
+    def report(self) -> dict:
+        return {
+            "total": self.total,
+            "stages": self.stages,
+            "mode_switches": self.mode_switches,
+            "depsgraph_updates": self.depsgraph_updates,
+            "cprofile": self.cprofile is not None, #stage times include its overhead
+        }
 
-    def generate_bones(self, context, verts: Lid, bone_name: str, top: bool):
-        '''Generates bones for all indices of the lid'''
-        # Switch to Object Mode
+#profiler of the running generate, None when instrumentation is off
+_profiler = None
+#profiler of the last instrumented generate, shown in the panel and exported
+last_profile = None
+
+def profile_stage(name: str, bones: int = 0):
+    '''Times a stage when instrumentation is on, a no-op context otherwise'''
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name, bones)
+
+def mode_set(mode: str):
+    '''bpy.ops.object.mode_set, counted when instrumentation is on'''
+    if _profiler is not None:
+        _profiler.mode_switches += 1
+        with _profiler.stage(f"mode_set {mode}"):
+            return bpy.ops.object.mode_set(mode=mode)
+    return bpy.ops.object.mode_set(mode=mode)
+
+@contextlib.contextmanager
+def profiling(enabled: bool, use_cprofile: bool = False):
+    '''Instruments generate calls inside the block and keeps the result as last_profile
+
+    use_cprofile also records a cProfile for the pstats export, its hooks slow down python heavy
+    stages, so stage times of a cProfile run read high.
+    '''
+    global _profiler, last_profile
+    if not enabled:
+        yield None
+        return
+    profiler = Profiler(use_cprofile)
+    _profiler = profiler
+    bpy.app.handlers.depsgraph_update_post.append(profiler.depsgraph_update)
+    start = time.perf_counter()
+    if profiler.cprofile:
+        profiler.cprofile.enable()
+    try:
+        yield profiler
+    finally:
+        if profiler.cprofile:
+            profiler.cprofile.disable()
+        profiler.total = time.perf_counter() - start
+        bpy.app.handlers.depsgraph_update_post.remove(profiler.depsgraph_update)
+        _profiler = None
+        last_profile = profiler
+
+#edit bone and constraint properties generate sets, saved by Journal before they change
+_EDIT_BONE_KEYS = ("roll", "use_connect", "use_deform", "bbone_segments", "bbone_handle_type_start",
+                   "bbone_handle_type_end", "bbone_easein", "bbone_easeout", "bbone_handle_use_ease_start",
+                   "bbone_handle_use_ease_end")
+_CONSTRAINT_KEYS = ("transform_channel", "target_space", "min", "max", "frame_start", "frame_end")
+
+class Journal():
+    '''Everything a generate run creates or changes, so a cancelled run is undone without the undo stack
+
+    Data that existed is saved before its first change, data the run creates is saved as None.
+    Vertex group weights are saved only for the vertices a step writes, a group about to be deleted
+    is read whole, a chunk of vertices per step.
+    '''
+    def __init__(self):
+        self.rigs = {} #rig name -> settings and lids
+        self.edit_bones = {} #(armature, bone) -> head, tail, parent, handles and _EDIT_BONE_KEYS
+        self.constraints = {} #(armature, bone, constraint) -> target, subtarget, action and _CONSTRAINT_KEYS
+        self.locations = {} #(armature, bone) -> pose location
+        self.actions = {} #action name -> use_fake_user
+        self.fcurves = {} #(action, data_path, index) -> (group, keyframe co)
+        self.groups = {} #(mesh object, group) -> {vertex: weight, None where not in the group}
+
+    def save_rig(self, rigs, name: str):
+        if name in self.rigs:
+            return
+        rig = rigs.get(name)
+        self.rigs[name] = None if rig is None else {
+            "armature": rig.armature, "mode": rig.mode, "bone_count": rig.bone_count, "mirror": rig.mirror,
+            "mesh_object": rig.mesh_object, "lids": [(lid.indices, lid.coordinates) for lid in (rig.upper, rig.lower)],
+        }
+
+    def save_edit_bone(self, obj, bones: dict, name: str, removing: bool = False):
+        key = (obj.name, name)
+        if key in self.edit_bones:
+            return
+        bone = bones.get(name)
+        if bone is None:
+            self.edit_bones[key] = None
+            return
+        state = {key: getattr(bone, key) for key in _EDIT_BONE_KEYS}
+        state.update(head=tuple(bone.head), tail=tuple(bone.tail), parent=bone.parent.name if bone.parent else "",
+                     handles=tuple(handle.name if handle else "" for handle in (bone.bbone_custom_handle_start, bone.bbone_custom_handle_end)))
+        self.edit_bones[key] = state
+        pose_bone = obj.pose.bones.get(name)
+        if removing and pose_bone:
+            #constraints go with the bone
+            for constraint in pose_bone.constraints:
+                if constraint.type == 'ACTION':
+                    self.save_constraint(obj, name, constraint.name)
+
+    def save_constraint(self, obj, bone: str, name: str):
+        key = (obj.name, bone, name)
+        if key in self.constraints:
+            return
+        pose_bone = obj.pose.bones.get(bone)
+        constraint = pose_bone.constraints.get(name) if pose_bone else None
+        if constraint is None or constraint.type != 'ACTION':
+            self.constraints[key] = None
+            return
+        state = {key: getattr(constraint, key) for key in _CONSTRAINT_KEYS}
+        state.update(target=constraint.target.name if constraint.target else "", subtarget=constraint.subtarget,
+                     action=constraint.action.name if constraint.action else "")
+        self.constraints[key] = state
+
+    def save_location(self, obj, bone: str):
+        self.locations.setdefault((obj.name, bone), tuple(obj.pose.bones[bone].location))
+
+    def save_action(self, name: str):
+        if name not in self.actions:
+            action = bpy.data.actions.get(name)
+            self.actions[name] = None if action is None else action.use_fake_user
+
+    def save_fcurve(self, action, data_path: str, index: int):
+        key = (action.name, data_path, index)
+        if key in self.fcurves or self.actions.get(action.name, False) is None:
+            return #keys of an action the run created go with it
+        fcurve = action.fcurves.find(data_path, index=index)
+        if fcurve is None:
+            self.fcurves[key] = None
+            return
+        co = np.empty(len(fcurve.keyframe_points) * 2, dtype=np.float32)
+        fcurve.keyframe_points.foreach_get("co", co)
+        self.fcurves[key] = (fcurve.group.name if fcurve.group else "", co)
+
+    def saved_group(self, mesh_obj, name: str):
+        '''Saved weights of a group, None if the run created it or it does not exist yet'''
+        key = (mesh_obj.name, name)
+        if key not in self.groups:
+            self.groups[key] = {} if name in mesh_obj.vertex_groups else None
+        return self.groups[key]
+
+    def save_group(self, mesh_obj, name: str, vertices):
+        '''Saves the weights of the given vertices in a group before a step writes or removes them'''
+        saved = self.saved_group(mesh_obj, name)
+        if saved is None:
+            return
+        group = mesh_obj.vertex_groups[name]
+        for vert in vertices:
+            if vert not in saved:
+                try:
+                    saved[vert] = group.weight(vert)
+                except RuntimeError: #vertex is not in the group
+                    saved[vert] = None
+
+    def save_groups_steps(self, mesh_obj, names):
+        '''Saves every weight of the named groups before they are deleted, yields after every _JOURNAL_VERTICES'''
+        columns = {}
+        for name in names:
+            saved = self.saved_group(mesh_obj, name)
+            if saved is not None:
+                columns[mesh_obj.vertex_groups[name].index] = saved
+        if not columns:
+            return
+        vertices = mesh_obj.data.vertices
+        for start in range(0, len(vertices), _JOURNAL_VERTICES):
+            for vert in vertices[start:start + _JOURNAL_VERTICES]:
+                for element in vert.groups:
+                    saved = columns.get(element.group)
+                    if saved is not None:
+                        saved.setdefault(vert.index, element.weight)
+            yield
+
+    def undo(self, context):
+        '''Restores everything saved, deletes everything created'''
         if bpy.context.mode != 'OBJECT':
-            bpy.ops.object.mode_set(mode='OBJECT')
-            bpy.ops.object.select_all(action='DESELECT')
-
-        obj = bpy.data.objects.get(context.scene.lid_armature) #armature object
-        if not obj:
-            raise ValueError(f"Armature {context.scene.lid_armature} doesnt exist!")
-        mesh_obj = bpy.data.objects.get(context.scene.lid_object) #mesh object
-
-        if not mesh_obj:
-            raise ValueError(f"Mesh Object {context.scene.lid_object} doesnt exist!")
-        armature = obj.data
-        context.view_layer.objects.active = obj
-        bpy.ops.object.mode_set(mode='EDIT')
-
-        # Iterate over sorted vertices and create bones
-        for i, vert in enumerate(verts.indices):
-            if (i == 0 or i == len(verts.indices)-1) and top:
-                #corner bone name
-                if i == 0:
-                    name = f"corner_{bone_name}_start" #name of the bone
-                else:
-                    name = f"corner_{bone_name}_end" #name of the bone
-            elif top:
-                name = f"{bone_name}_{i-1}" #name of the bone - 1 corner bone
+            mode_set('OBJECT')
+        self.undo_rigs(context.scene.lid_rigs)
+        self.undo_edit_bones(context)
+        for (armature, bone, name), state in self.constraints.items():
+            pose_bone = self.pose_bone(armature, bone)
+            if pose_bone is None:
+                continue
+            constraint = pose_bone.constraints.get(name)
+            if constraint:
+                pose_bone.constraints.remove(constraint)
+            if state is not None:
+                constraint = pose_bone.constraints.new(type='ACTION')
+                constraint.name = name
+                constraint.target = bpy.data.objects.get(state["target"])
+                constraint.subtarget = state["subtarget"]
+                constraint.action = bpy.data.actions.get(state["action"])
+                for key in _CONSTRAINT_KEYS:
+                    setattr(constraint, key, state[key])
+        for (armature, bone), location in self.locations.items():
+            pose_bone = self.pose_bone(armature, bone)
+            if pose_bone:
+                pose_bone.location = location
+        for (name, data_path, index), state in self.fcurves.items():
+            action = bpy.data.actions.get(name)
+            if action is None:
+                continue
+            fcurve = action.fcurves.find(data_path, index=index)
+            if fcurve:
+                action.fcurves.remove(fcurve)
+            if state is not None:
+                group, co = state
+                fcurve = action.fcurves.new(data_path, index=index, action_group=group)
+                fcurve.keyframe_points.add(len(co) // 2)
+                fcurve.keyframe_points.foreach_set("co", co)
+                fcurve.update()
+        for name, use_fake_user in self.actions.items():
+            action = bpy.data.actions.get(name)
+            if action is None:
+                continue
+            if use_fake_user is None:
+                bpy.data.actions.remove(action)
             else:
-                name = f"{bone_name}_{i}" #name of the bone
-            if name in armature.edit_bones:
-                armature.edit_bones.remove(armature.edit_bones[name])  # Remove if bone exists in armature
-            bone = armature.edit_bones.new(name=name)
-            #add bone to the list
-            verts.bones.append(bone.name)
-            #set bone position
-            bone.head = mesh_obj.matrix_world @ verts.coordinates[i]
-            bone.tail = bone.head + Vector((0, 0, _BONE_SCALE))  # Adjust the tail position as needed
-
-            #vert.weight = f"DEF-{bone.name}"
-    
-    def generate_controller(self, context, bone_name: str, position: Vector):
-        obj = bpy.data.objects.get(context.scene.lid_armature) #armature object
-        if not obj:
-            raise ValueError(f"Armature {context.scene.lid_armature} doesnt exist!")
-        armature = obj.data
-        #create Action ctrl bone
-        if bone_name in armature.edit_bones:
-            armature.edit_bones.remove(armature.edit_bones[bone_name])  # Remove if bone exists in armature
-        bone = armature.edit_bones.new(name=bone_name)
-        
-        #set bone position
-        bone.head = position
-        bone.tail = bone.head + Vector((0, 0, _BONE_SCALE/2))  # Adjust the tail position as needed
-
-        #store ctrl bone name
-        context.scene.lid_ctrl_bone = bone.name
-
-    def move_bone_to_bone(self, context, bone1: str, bone2: str):
-        '''moving bones adding keyframes, assuming we have action active where we add keyframes'''
-        #check if armature, bones exist
-        armature = bpy.data.objects.get(context.scene.lid_armature) #armature object
-        if not armature:
-            raise ValueError(f"Armature {context.scene.lid_armature} doesnt exist!")
-        if not armature.animation_data and not armature.animation_data.action:
-            raise ValueError(f"Armature {context.scene.lid_armature} doesnt have action assigned!")
-
-        # Define source and target bones
-        pbon1 = armature.pose.bones.get(bone1)
-        pbon2 = armature.pose.bones.get(bone2)
-
-        if not pbon1 or not pbon2:
-            raise ValueError(f"Bones {bone1} or {bone2} dont exist!")
-
-        # Insert a keyframe for the target bone's location
-        frame = 0
-        #reset position
-        pbon1.location = [0,0,0]
-        pbon2.location = [0,0,0]
-
-        pbon1.keyframe_insert(data_path="location", frame=frame)
-        print(f"{bone1} location on frame {frame} is {list(pbon1.location)}")
-
-        # Get the world space location of the source bone
-        source_location = armature.matrix_world @ pbon2.matrix.copy()
-        
-        # Move the target bone to the source location
-        pbon1.matrix = source_location
-        
-        # Insert a keyframe for the target bone's locationframe
-        frame = 2
-        pbon1.keyframe_insert(data_path="location", frame=frame)
-        print(f"{bone1} location on frame {frame} is {list(pbon1.location)}")
-
-    def add_action_constraint(self, context, bone: str, ctrl_bone: str, action_name: str, constraint_name: str):
-        '''add constraint and set parameters'''
-        #check if armature, bones exist
-        armature = bpy.data.objects.get(context.scene.lid_armature) #armature object
-        action = bpy.data.actions.get(action_name)
-        if not armature:
-            raise ValueError(f"Armature {context.scene.lid_armature} doesnt exist!")
-        if not armature.animation_data and not armature.animation_data.action:
-            raise ValueError(f"Armature {context.scene.lid_armature} doesnt have action assigned!")
-
-        # Define source and target bones
-        pbone = armature.pose.bones.get(bone)
-        ctrl_pose_bone = armature.pose.bones.get(ctrl_bone)
-
-        if not pbone or not ctrl_pose_bone:
-            raise ValueError(f"Bones {bone} or {ctrl_bone} dont exist!")
-
-        #check if bone has constraint 'lid-action' and remove it
-        if pbone.constraints:
-            for constraint in [c for c in pbone.constraints if c.type == 'ACTION' and c.name == constraint_name]:
-                pbone.constraints.remove(constraint)
-        
-        #add constraint to the list
-        constraint = pbone.constraints.new(type='ACTION')
-        constraint.target = armature
-        constraint.subtarget = ctrl_bone
-        constraint.transform_channel = _CTRL_BONE_ACTION_AXIS
-        constraint.target_space = 'LOCAL'
-        constraint.min = _CTRL_BONE_ACTION_MIN
-        constraint.max = _CTRL_BONE_ACTION_MAX
-        constraint.action = action
-        constraint.frame_start = _ACTION_FRAME_START
-        constraint.frame_end = _ACTION_FRAME_END
-
-
-    def generate_action(self, context, action_name: str):
-        '''add action to selected armature and add three keyframes opened and closed eyelids'''
-        # Force update by exiting edit mode
-        bpy.ops.object.mode_set(mode='OBJECT')
-        upper_bones = context.scene.upper_lid.bones
-        lower_bones = context.scene.lower_lid.bones
-        controller_bone = context.scene.lid_ctrl_bone
-
-        #check if armature, bones exist
-        obj = bpy.data.objects.get(context.scene.lid_armature) #armature object
-        if not obj:
-            raise ValueError(f"Armature {context.scene.lid_armature} doesnt exist!")
-        armature = obj.data
-        pose_test = [b.name for b in obj.pose.bones]
+                action.use_fake_user = use_fake_user
+        self.undo_groups()
+
+    def undo_rigs(self, rigs):
+        for name, state in self.rigs.items():
+            index = rigs.find(name)
+            if index == -1:
+                continue
+            if state is None:
+                rigs.remove(index)
+                continue
+            rig = rigs[index]
+            for key in ("armature", "mode", "bone_count", "mirror", "mesh_object"):
+                setattr(rig, key, state[key])
+            for lid, (indices, coordinates) in zip((rig.upper, rig.lower), state["lids"]):
+                lid.indices, lid.coordinates = indices, coordinates
+
+    def undo_edit_bones(self, context):
+        armatures = {bpy.data.objects.get(armature) for armature, bone in self.edit_bones} - {None}
+        if not armatures:
+            return
+        bpy.ops.object.select_all(action='DESELECT')
+        for obj in armatures:
+            obj.select_set(True)
+        context.view_layer.objects.active = next(iter(armatures))
+        mode_set('EDIT')
+        for (armature, name), state in self.edit_bones.items():
+            obj = bpy.data.objects.get(armature)
+            if obj is None:
+                continue
+            edit_bones = obj.data.edit_bones
+            bone = edit_bones.get(name)
+            if state is None:
+                if bone:
+                    edit_bones.remove(bone)
+                continue
+            bone = bone or edit_bones.new(name=name)
+            bone.head, bone.tail = state["head"], state["tail"]
+            for key in _EDIT_BONE_KEYS:
+                setattr(bone, key, state[key])
+        #links once every bone is back
+        for (armature, name), state in self.edit_bones.items():
+            obj = bpy.data.objects.get(armature)
+            if obj is None or state is None:
+                continue
+            edit_bones = obj.data.edit_bones
+            bone = edit_bones[name]
+            bone.parent = edit_bones.get(state["parent"])
+            bone.bbone_custom_handle_start, bone.bbone_custom_handle_end = (edit_bones.get(handle) for handle in state["handles"])
+        mode_set('OBJECT')
+
+    def undo_groups(self):
+        for (mesh_name, name), weights in self.groups.items():
+            mesh_obj = bpy.data.objects.get(mesh_name)
+            if mesh_obj is None:
+                continue
+            group = mesh_obj.vertex_groups.get(name)
+            if weights is None:
+                if group:
+                    mesh_obj.vertex_groups.remove(group)
+                continue
+            if group is None:
+                group = mesh_obj.vertex_groups.new(name=name)
+            else:
+                group.remove(list(weights))
+            buckets = {}
+            for vert, weight in weights.items():
+                if weight is not None:
+                    buckets.setdefault(weight, []).append(vert)
+            for weight, verts in buckets.items():
+                group.add(verts, weight, 'REPLACE')
+
+    @staticmethod
+    def pose_bone(armature: str, bone: str):
+        obj = bpy.data.objects.get(armature)
+        return obj.pose.bones.get(bone) if obj else None
+
+class RigPlan():
+    '''Plan of a lid rig bound to the rig, armature and mesh objects it is applied to'''
+    def __init__(self, rig):
+        self.rig = rig
+        self.obj = get_object(rig.armature, "Armature") #armature object
+        self.mesh_obj = get_object(rig.mesh_object, "Mesh Object") #mesh object
+        self.layout = plan_rig(rig.name, rig.armature, rig.mesh_object, rig.upper.indices, rig.upper.coordinates,
+                               rig.lower.indices, rig.lower.coordinates, np.array(self.mesh_obj.matrix_world),
+                               rig.mode, rig.bone_count)
+
+    def __getattr__(self, name):
+        #bone names, positions and settings read through to the pure plan
+        if name == "layout":
+            raise AttributeError(name)
+        return getattr(self.layout, name)
+
+    def stored_state(self) -> dict:
+        '''State of the last generate as saved on the rig, same layout as LidRigPlan.state'''
+        return {
+            "bones": [dict(zip(lid.bones, lid.hashes.tolist())) for lid in (self.rig.upper, self.rig.lower)],
+            "ctrl_bone": self.rig.ctrl_bone,
+            "ctrl_hash": self.rig.ctrl_hash,
+            "fingerprint": self.rig.fingerprint,
+        }
+
+    def unchanged(self) -> bool:
+        '''True if the last generate used the same inputs and its bones and action still exist'''
+        if self.rig.fingerprint != self.fingerprint or self.action_name not in bpy.data.actions:
+            return False
+        bones = self.obj.data.bones
+        return all(name in bones for name in self.names())
+
+    def changed_bones(self, force: bool = False):
+        '''Returns (changed, removed) bone names compared with the last generate, force changes every bone'''
+        return self.layout.diff(self.stored_state(), self.obj.data.bones, force)
+
+    def store(self):
+        '''Records generated bones and fingerprint on the rig'''
+        for lid, plan in zip((self.rig.upper, self.rig.lower), self.lids):
+            lid.bones = plan.names
+            lid.hashes = plan.hashes
+            lid.bound = () if plan.binding is None else np.unique(plan.binding[0])
+        self.rig.ctrl_bone = self.ctrl_bone
+        self.rig.ctrl_hash = self.ctrl_hash
+        self.rig.fingerprint = self.fingerprint
+
+def run_steps(steps):
+    '''Runs a step generator to its end and returns its return value'''
+    while True:
+        try:
+            next(steps)
+        except StopIteration as done:
+            return done.value
+
+def generate_bones(context, plans, changes):
+    '''Places changed bones and deletes removed ones for all plans in one edit mode session'''
+    run_steps(generate_bones_steps(context, plans, changes))
+
+def generate_bones_steps(context, plans, changes, journal=None):
+    '''generate_bones as a generator, yields after every bone placed or deleted, journal saves what changes'''
+    armatures = {plan.obj.name: plan.obj for plan, (changed, removed) in zip(plans, changes) if changed or removed}
+    if not armatures:
+        return
+    # Switch to Object Mode
+    if bpy.context.mode != 'OBJECT':
+        mode_set('OBJECT')
+    bpy.ops.object.select_all(action='DESELECT')
+
+    #every armature enters edit mode together, one mode switch for the whole batch
+    for obj in armatures.values():
+        obj.select_set(True)
+    context.view_layer.objects.active = next(iter(armatures.values()))
+    mode_set('EDIT')
+    #name index built once per armature, replaces a lookup per bone in edit_bones
+    bones = {name: {bone.name: bone for bone in obj.data.edit_bones} for name, obj in armatures.items()}
+
+    for plan, (changed, removed) in zip(plans, changes):
+        if not (changed or removed):
+            continue
+        armature, index = plan.obj.data, bones[plan.obj.name]
+        for name in removed:
+            if name in index:
+                if journal:
+                    journal.save_edit_bone(plan.obj, index, name, removing=True)
+                armature.edit_bones.remove(index.pop(name))
+            yield
+        for lid in plan.lids:
+            for name, head, tail in zip(lid.names, lid.heads.tolist(), lid.tails.tolist()):
+                if name in changed:
+                    if journal:
+                        journal.save_edit_bone(plan.obj, index, name)
+                    place_edit_bone(armature, index, name, head, tail)
+                    yield
+        if plan.ctrl_bone in changed:
+            if journal:
+                journal.save_edit_bone(plan.obj, index, plan.ctrl_bone)
+            #create Action ctrl bone
+            place_edit_bone(armature, index, plan.ctrl_bone, plan.ctrl_head.tolist(), plan.ctrl_tail.tolist())
+            yield
+        if plan.bbone and changed.intersection(plan.lids[0].names):
+            if journal:
+                for key in ("name", "start", "end"):
+                    journal.save_edit_bone(plan.obj, index, plan.bbone[key])
+            configure_bbone(index, plan.bbone)
+
+def remove_location_keys(action, bones, journal=None):
+    '''Removes location F-curves of the given bones, and the Y scale F-curve B-Bone handles have'''
+    for name in bones:
+        path = f'pose.bones["{bpy.utils.escape_identifier(name)}"]'
+        for data_path, axis in [(path + '.location', axis) for axis in range(3)] + [(path + '.scale', 1)]:
+            fcurve = action.fcurves.find(data_path, index=axis)
+            if fcurve:
+                if journal:
+                    journal.save_fcurve(action, data_path, axis)
+                action.fcurves.remove(fcurve)
+
+def generate_actions(context, plans, changes):
+    '''Keys opened and closed eyelids and adds constraints for changed bones without posing the bones'''
+    run_steps(generate_actions_steps(context, plans, changes))
+
+def generate_actions_steps(context, plans, changes, journal=None):
+    '''generate_actions as a generator, yields after the keys of a rig and after every constraint'''
+    # Leave edit mode so edit bones are written back to bones
+    if bpy.context.mode != 'OBJECT':
+        mode_set('OBJECT')
+    #rest matrices are read once per armature and shared by its rigs
+    rests = {}
+    for plan, (changed, removed) in zip(plans, changes):
+        obj = plan.obj
+        upper_bones, lower_bones = plan.lids[0].names, plan.lids[1].names
+        # Check for length match
+        if len(plan.moving) != len(plan.closed_heads):
+            raise ValueError("The moving and closed bone lists have mismatched lengths.")
+        #check if bones exist
         for b in upper_bones + lower_bones:
-            bone = obj.pose.bones.get(b)
-            if not bone:
+            if not obj.pose.bones.get(b):
                 raise ValueError(f"Bone {b} doesnt exist")
-        #create action and add it to armature object
-        action = bpy.data.actions.get(action_name)
-        if action:
-            bpy.data.actions.remove(action)
-        if obj.animation_data:
-            obj.animation_data_clear()
-        action = bpy.data.actions.new(action_name)
-        print(f"action {action.name} is created")
-        anim_data = obj.animation_data_create()
-        obj.animation_data.action = action
 
-        #force update
-        bpy.ops.object.mode_set(mode='POSE')
+        #keys are written straight to F-curves so the action is never assigned to the armature
+        if journal:
+            journal.save_action(plan.action_name)
+        action = bpy.data.actions.get(plan.action_name)
+        moving_bones = plan.moving
+        if action:
+            remove_location_keys(action, [b for b in moving_bones if b in changed] + list(removed), journal)
+        else:
+            action = bpy.data.actions.new(plan.action_name)
+            print(f"action {action.name} is created")
+            changed = changed | set(moving_bones)
+        #set fake user, action is only used by the constraints
+        action.use_fake_user = True
 
-        # Check for length match
-        if len(upper_bones)-2 != len(lower_bones):
-            raise ValueError("The two bone lists have mismatched lengths.")
-        #formulate a dict of bones
-        for a, b in zip(upper_bones[1:-1], lower_bones[:]):
-            #move top lid bones to bottom lid bones location
-            self.move_bone_to_bone(context, a, b)
+        #move top lid bones to bottom lid bones location, or B-Bone handles to the closed curve
+        pairs = [(i, a) for i, a in enumerate(moving_bones) if a in changed]
+        if not pairs:
+            continue
+        if obj.name not in rests:
+            rests[obj.name] = rest_matrices(obj)
+        rest, index = rests[obj.name]
+        bones = [a for i, a in pairs]
+        if plan.targets is not None:
+            offsets = closed_pose_offsets(obj, rest, index, bones, [plan.targets[i] for i, a in pairs])
+        else:
+            offsets = closed_point_offsets(obj, rest, index, bones, plan.closed_heads[[i for i, a in pairs]])
+        write_location_keys(action, bones, offsets, journal)
+        if plan.bbone is not None:
+            #handle lengths of the closed curve, the moving bones are the start and end handle
+            write_scale_keys(action, bones, [plan.bbone["ease_scale"][plan.moving.index(a)] for a in bones], journal)
+        yield
+        for a in bones:
+            if journal:
+                journal.save_location(obj, a)
+                journal.save_constraint(obj, a, plan.constraint["name"])
+            obj.pose.bones[a].location = (0, 0, 0) #reset position
             #add action constraint to bone1 target to controller bone Y axis Local space
-            self.add_action_constraint(context, a, controller_bone, action.name, action.name + '-constraint')
+            add_action_constraint(obj, a, plan.ctrl_bone, action, plan.constraint)
+            yield
 
-        #force update
-        bpy.ops.object.mode_set(mode='OBJECT')
+def bind_lid_weights(plans, changes):
+    '''Writes the interpolation weights of resampled lids to vertex groups named after their bones'''
+    run_steps(bind_lid_weights_steps(plans, changes))
 
-        #set frame 0 before action detach
-        context.scene.frame_current = 0
-        context.view_layer.update()
+def bind_lid_weights_steps(plans, changes, journal=None):
+    '''bind_lid_weights as a generator, yields after every vertex group'''
+    for plan, (changed, removed) in zip(plans, changes):
+        vertex_groups = plan.mesh_obj.vertex_groups
+        groups = {group.name: group for group in vertex_groups}
+        #groups of deleted bones go with them
+        deleted = [name for name in removed if name in groups]
+        if journal:
+            yield from journal.save_groups_steps(plan.mesh_obj, deleted)
+        for name in deleted:
+            vertex_groups.remove(groups.pop(name))
+        if plan.rig.fingerprint != plan.fingerprint:
+            #a mode, bone count or lid change can rebind vertices under reused bone names, e.g.
+            #upper_lid_0.L of a resampled lid and of a per vertex one, so the vertices the last generate
+            #bound are cleared from every bone group, hand painted weights of per vertex bones are kept
+            stale = np.union1d(plan.rig.upper.bound, plan.rig.lower.bound).tolist()
+            if stale:
+                for group in [groups[name] for name in plan.names() if name in groups]:
+                    if journal:
+                        journal.save_group(plan.mesh_obj, group.name, stale)
+                    group.remove(stale)
+        lid_verts = np.concatenate([lid.indices for lid in plan.lids]).tolist()
+        for lid in plan.lids:
+            if lid.binding is None:
+                continue
+            indices, bones, weights = lid.binding
+            for i, name in enumerate(lid.names):
+                mask = bones == i
+                group = groups.get(name)
+                if journal and (group is not None or mask.any()):
+                    journal.save_group(plan.mesh_obj, name, lid_verts) #binding indices are lid verts
+                if group is None:
+                    if not mask.any():
+                        continue
+                    group = groups[name] = vertex_groups.new(name=name)
+                group.remove(lid_verts) #clear weights of vertices bound to other bones since last generate
+                if mask.any():
+                    write_group_weights(group, indices[mask], weights[mask])
+                yield
 
-        #set fake user and remove action from Armature
-        action.use_fake_user = True
-        obj.animation_data.action = None
+def generate_rigs(context, rigs, force: bool = False):
+    '''Builds bones, controllers, actions and constraints for all rigs in one pass
+
+    Only bones whose inputs changed since the last generate are touched, unchanged rigs are
+    skipped entirely. force rebuilds everything. Returns the number of rigs that were updated.
+    '''
+    return run_steps(generate_rigs_steps(context, rigs, force))
+
+def generate_rigs_steps(context, rigs, force: bool = False, journal=None):
+    '''generate_rigs as a generator, yields (stage, done, total) after every bone, constraint or vertex group
+
+    Rigs store their generate inputs after the last stage, a run stopped early leaves them out of date.
+    A journal records what the run changes so journal.undo can take back a run stopped early.
+    '''
+    rigs = list(rigs)
+    if any(rig.mirror for rig in rigs):
+        #opposite side rigs are filled first and generated in the same pass
+        with profile_stage("mirror", len(rigs)):
+            sources = [rig.name for rig in rigs]
+            mirrored = []
+            for name in [rig.name for rig in rigs if rig.mirror]:
+                if journal:
+                    journal.save_rig(context.scene.lid_rigs, mirror_side(name))
+                mirrored.append(mirror_rig(context, context.scene.lid_rigs[name]))
+            scene_rigs = context.scene.lid_rigs
+            rigs = [scene_rigs[name] for name in dict.fromkeys(sources + mirrored)]
+    names = [(rig.armature, rig.name) for rig in rigs]
+    if len(set(names)) != len(names):
+        raise ValueError("Lid rigs sharing an armature need unique names")
+    with profile_stage("plan", len(rigs)):
+        plans = [RigPlan(rig) for rig in rigs]
+    yield ("plan", len(plans), len(plans))
+    plans = [plan for plan in plans if force or not plan.unchanged()]
+    if not plans:
+        return 0
+    changes = [plan.changed_bones(force) for plan in plans]
+    touched = sum(len(changed) + len(removed) for changed, removed in changes)
+    #generate bones for lid and CTRL bone for Action trigger
+    with profile_stage("generate_bones", touched):
+        for done, _ in enumerate(generate_bones_steps(context, plans, changes, journal), start=1):
+            yield ("bones", done, touched)
+    #generate action with keyframes
+    moving = sum(len(plan.moving) + 1 for plan in plans)
+    with profile_stage("generate_actions", touched):
+        for done, _ in enumerate(generate_actions_steps(context, plans, changes, journal), start=1):
+            yield ("actions", done, moving)
+    #bind resampled lid vertices to their bones
+    groups = sum(len(lid.names) for plan in plans for lid in plan.lids if lid.binding is not None)
+    with profile_stage("bind_weights", touched):
+        for done, _ in enumerate(bind_lid_weights_steps(plans, changes, journal), start=1):
+            yield ("weights", done, groups)
+    for plan in plans:
+        plan.store()
+    return len(plans)
+
+def ready_rigs(context):
+    '''Rigs that have both lids set'''
+    return [rig for rig in context.scene.lid_rigs if len(rig.upper.indices) and len(rig.lower.indices)]
+
+def evaluated_coordinates(context, obj):
+    '''Returns (N, 3) float32 array of deformed local vertex coordinates of obj'''
+    context.view_layer.update()
+    evaluated = obj.evaluated_get(context.evaluated_depsgraph_get())
+    mesh = evaluated.to_mesh()
+    try:
+        if len(mesh.vertices) != len(obj.data.vertices):
+            raise ValueError(f"Modifiers of {obj.name} change its vertex count, the lid cannot be baked")
+        return mesh_coordinates(mesh)
+    finally:
+        evaluated.to_mesh_clear()
+
+def check_rig_weights(rig, mesh_obj, purpose: str):
+    '''Raises ValueError unless mesh_obj has a vertex group named after one of the rig lid bones'''
+    bones = set(rig.upper.bones + rig.lower.bones)
+    if not any(group.name in bones for group in mesh_obj.vertex_groups):
+        hint = "set Bones above 0 and generate again" if rig.paired_by_vertex() else "generate the rig first"
+        raise ValueError(f"{mesh_obj.name} has no vertex groups of lid rig {rig.name} bones to {purpose}, "
+                         f"per vertex lid bones bind no weights, {hint}")
+
+def bake_lid_shape_key(context, rig, threshold: float = 1e-6):
+    '''Bakes the closed lid of a generated rig into a shape key named after its action
+
+    The mesh is evaluated once at _ACTION_FRAME_START and once at _ACTION_FRAME_END through the
+    controller, only vertices that move more than threshold are written. Returns the moved vertex count.
+    '''
+    obj = get_object(rig.armature, "Armature")
+    mesh_obj = get_object(rig.mesh_object, "Mesh Object")
+    if not rig.ctrl_bone or rig.ctrl_bone not in obj.pose.bones:
+        raise ValueError(f"Lid rig {rig.name} is not generated")
+    if not any(m.type == 'ARMATURE' and m.object == obj for m in mesh_obj.modifiers):
+        raise ValueError(f"{mesh_obj.name} is not deformed by {obj.name}, add an Armature modifier")
+    check_rig_weights(rig, mesh_obj, "bake")
+    if bpy.context.mode != 'OBJECT':
+        mode_set('OBJECT')
+    ctrl = obj.pose.bones[rig.ctrl_bone]
+    axis = 'XYZ'.index(_CTRL_BONE_ACTION_AXIS[-1])
+    rest_location = ctrl.location[axis]
+    try:
+        #controller min and max map to the first and last frame of the action
+        samples = []
+        for value in (_CTRL_BONE_ACTION_MIN, _CTRL_BONE_ACTION_MAX):
+            ctrl.location[axis] = value
+            with profile_stage("bake_evaluate", len(mesh_obj.data.vertices)):
+                samples.append(evaluated_coordinates(context, mesh_obj))
+    finally:
+        ctrl.location[axis] = rest_location
+    #sparse deltas, a lid moves a few hundred verts of a million vertex head
+    delta = samples[1] - samples[0]
+    moved = np.flatnonzero(np.abs(delta).max(axis=1) > threshold)
+    delta = delta[moved]
+
+    with profile_stage("bake_write", len(moved)):
+        if not mesh_obj.data.shape_keys:
+            mesh_obj.shape_key_add(name="Basis", from_mix=False)
+        key_blocks = mesh_obj.data.shape_keys.key_blocks
+        name = side_name(_ACTION_NAME, rig.name)
+        key = key_blocks.get(name) or mesh_obj.shape_key_add(name=name, from_mix=False)
+        co = np.empty(len(mesh_obj.data.vertices) * 3, dtype=np.float32)
+        key.relative_key.data.foreach_get("co", co)
+        co = co.reshape(-1, 3)
+        co[moved] += delta
+        key.data.foreach_set("co", co.ravel())
+        key.value = 0
+        mesh_obj.data.update()
+    return len(moved)
+
+def remove_lid_rig(context, rig):
+    '''Deletes the generated bones, their constraints and vertex groups and the action of a rig'''
+    obj = get_object(rig.armature, "Armature")
+    names = set(rig.upper.bones + rig.lower.bones + ([rig.ctrl_bone] if rig.ctrl_bone else []))
+    if bpy.context.mode != 'OBJECT':
+        mode_set('OBJECT')
+    bpy.ops.object.select_all(action='DESELECT')
+    obj.select_set(True)
+    context.view_layer.objects.active = obj
+    mode_set('EDIT')
+    edit_bones = obj.data.edit_bones
+    for name in names:
+        bone = edit_bones.get(name)
+        if bone:
+            edit_bones.remove(bone) #constraints of the bone go with it
+    mode_set('OBJECT')
+    mesh_obj = bpy.data.objects.get(rig.mesh_object)
+    if mesh_obj:
+        for group in [group for group in mesh_obj.vertex_groups if group.name in names]:
+            mesh_obj.vertex_groups.remove(group)
+    action = bpy.data.actions.get(side_name(_ACTION_NAME, rig.name))
+    if action:
+        bpy.data.actions.remove(action)
+    for lid in (rig.upper, rig.lower):
+        lid.bones = []
+        lid.hashes = []
+        lid.bound = []
+    rig.ctrl_bone = ''
+    rig.ctrl_hash = 0
+    rig.fingerprint = ''
+
+#BVH tree per lid mesh pointer, rebuilt when the topology or the coordinates change, the oldest dropped past _MESH_CACHE_SIZE
+_bvh_cache = {}
+
+def lid_surface(mesh):
+    '''Returns (BVH tree, (T, 3) triangle vertex indices, (N, 3) coordinates) of a mesh, the tree is cached'''
+    mesh.calc_loop_triangles()
+    coordinates = mesh_coordinates(mesh)
+    key = (len(mesh.vertices), len(mesh.loop_triangles), input_hash(coordinates.tobytes()))
+    cached = _bvh_cache.pop(mesh.as_pointer(), None)
+    if cached is None or cached[0] != key:
+        triangles = np.empty(len(mesh.loop_triangles) * 3, dtype=np.int32)
+        mesh.loop_triangles.foreach_get("vertices", triangles)
+        triangles = triangles.reshape(-1, 3)
+        tree = BVHTree.FromPolygons(coordinates.tolist(), triangles.tolist(), all_triangles=True)
+        cached = (key, tree, triangles)
+    _bvh_cache[mesh.as_pointer()] = cached
+    while len(_bvh_cache) > _MESH_CACHE_SIZE:
+        del _bvh_cache[next(iter(_bvh_cache))]
+    return cached[1], cached[2], coordinates
+
+def vertex_group_weights(mesh, vertices, group_indices):
+    '''Returns (len(vertices), len(group_indices)) weights of the given vertices, 0 where not in a group'''
+    column = {group: i for i, group in enumerate(group_indices)}
+    weights = np.zeros((len(vertices), len(group_indices)))
+    mesh_vertices = mesh.vertices
+    for row, vert in enumerate(vertices.tolist()):
+        for element in mesh_vertices[vert].groups:
+            i = column.get(element.group)
+            if i is not None:
+                weights[row, i] = element.weight
+    return weights
+
+def rig_weight_groups(rig):
+    '''Names of the lid mesh vertex groups that deform with the rig armature'''
+    mesh_obj = get_object(rig.mesh_object, "Mesh Object")
+    bones = get_object(rig.armature, "Armature").data.bones
+    names = [group.name for group in mesh_obj.vertex_groups if group.name in bones or group.name.startswith("DEF-")]
+    if not any(name.startswith("DEF-") for name in names):
+        #without eye_bones DEF weights the rig bone groups are the only source
+        check_rig_weights(rig, mesh_obj, "transfer")
+    return names
+
+def transfer_lid_weights(source, targets, group_names, max_distance: float = _TRANSFER_DISTANCE):
+    '''Copies the group_names weights of source onto every target mesh object
+
+    Each target vertex takes the weights at its nearest point on the source surface, interpolated
+    over the triangle hit. Vertices farther than max_distance in source object space are cleared.
+    Returns the number of target vertices that got weights.
+    '''
+    groups = [source.vertex_groups[name] for name in group_names if name in source.vertex_groups]
+    if not targets:
+        return 0
+    if not groups:
+        raise ValueError(f"{source.name} has none of the vertex groups {list(group_names)}, nothing to transfer")
+    with profile_stage("transfer_tree", len(source.data.vertices)):
+        tree, triangles, coordinates = lid_surface(source.data)
+    inverse = np.linalg.inv(np.array(source.matrix_world))
+    hits = []
+    with profile_stage("transfer_query"):
+        for target in targets:
+            local = world_coordinates(inverse @ np.array(target.matrix_world), mesh_coordinates(target.data))
+            verts, points, faces = [], [], []
+            for i, co in enumerate(local.tolist()):
+                location, normal, index, distance = tree.find_nearest(co, max_distance)
+                if location is not None:
+                    verts.append(i)
+                    points.append(location)
+                    faces.append(index)
+            hits.append((target, np.array(verts, dtype=np.int64), np.array(points, dtype=float).reshape(-1, 3),
+                         np.array(faces, dtype=np.int64)))
+    #source weights are read once for every triangle corner any target landed on
+    needed = np.unique(triangles[np.concatenate([faces for *_, faces in hits])])
+    table = vertex_group_weights(source.data, needed, [group.index for group in groups])
+    count = 0
+    with profile_stage("transfer_write"):
+        for target, verts, points, faces in hits:
+            corners = triangles[faces]
+            barycentric = barycentric_weights(points, *(coordinates[corners[:, k]] for k in range(3)))
+            weights = np.einsum('nk,nkg->ng', barycentric, table[np.searchsorted(needed, corners)])
+            all_verts = list(range(len(target.data.vertices)))
+            for column, group in enumerate(groups):
+                target_group = target.vertex_groups.get(group.name) or target.vertex_groups.new(name=group.name)
+                target_group.remove(all_verts) #stale weights of vertices that moved out of reach
+                write_group_weights(target_group, verts, weights[:, column])
+            count += len(verts)
+    return count
+
+class VIEW3D_OT_vizor_generate_lid_rig(bpy.types.Operator):
+    bl_idname = "object.vizor_generate_lid_rig"
+    bl_label = "Operator to rig lid"
+
+    lidIndex: bpy.props.IntProperty(default=0)
+    force: bpy.props.BoolProperty(name="Rebuild all", description="Rebuild bones that did not change", default=False)
 
     def execute(self, context):
-        bpy.ops.object.mode_set(mode='OBJECT') #set object mode
-        #clear bones just in case we run generate 2nd time
-        context.scene.upper_lid.bones = []
-        context.scene.lower_lid.bones = []
-        context.scene.lid_ctrl_bone = ''
+        with profiling(context.scene.lid_profile, context.scene.lid_cprofile):
+            mode_set('OBJECT') #set object mode
+            updated = generate_rigs(context, [context.scene.lid_rigs[self.lidIndex]], self.force)
+        if not updated:
+            self.report({'INFO'}, "Lid rig is up to date")
+        return {'FINISHED'}
 
-        assert bpy.context.mode == 'OBJECT'
-        #generate bones for lid and CTRL bone for Action trigger
-        self.generate_bones(context, context.scene.upper_lid, 'upper_lid', True)
+class VIEW3D_OT_vizor_generate_all_lid_rigs(bpy.types.Operator):
+    bl_idname = "object.vizor_generate_all_lid_rigs"
+    bl_label = "Operator to rig all lids"
 
-        armature = bpy.data.objects.get(context.scene.lid_armature).data
+    force: bpy.props.BoolProperty(name="Rebuild all", description="Rebuild bones that did not change", default=False)
 
-        self.generate_bones(context, context.scene.lower_lid, 'lower_lid', False)
+    def execute(self, context):
+        rigs = ready_rigs(context)
+        if not rigs:
+            self.report({'WARNING'}, "No lid rig has both lids set")
+            return {'CANCELLED'}
+        with profiling(context.scene.lid_profile, context.scene.lid_cprofile):
+            if bpy.context.mode != 'OBJECT':
+                mode_set('OBJECT') #set object mode
+            updated = generate_rigs(context, rigs, self.force)
+        print(f"{updated} of {len(rigs)} lid rigs generated")
+        return {'FINISHED'}
+
+#(stage, overall fraction) of the running modal generate, None when none runs
+modal_progress = None
+
+class VIEW3D_OT_vizor_generate_lid_rig_modal(bpy.types.Operator):
+    bl_idname = "object.vizor_generate_lid_rig_modal"
+    bl_label = "Generate lid rigs with progress"
+
+    lidIndex: bpy.props.IntProperty(default=0)
+    all: bpy.props.BoolProperty(name="All rigs", description="Generate every rig that has both lids set", default=False)
+    force: bpy.props.BoolProperty(name="Rebuild all", description="Rebuild bones that did not change", default=False)
 
-        position = (context.scene.upper_lid.coordinates[0] + context.scene.upper_lid.coordinates[-1]) / 2 #find mid position for ctrl
-        self.generate_controller(context, 'ctrl_lid', position)
+    def invoke(self, context, event):
+        global modal_progress
+        if modal_progress is not None:
+            self.report({'WARNING'}, "A lid rig generate is already running")
+            return {'CANCELLED'}
+        rigs = ready_rigs(context) if self.all else [context.scene.lid_rigs[self.lidIndex]]
+        if not rigs:
+            self.report({'WARNING'}, "No lid rig has both lids set")
+            return {'CANCELLED'}
+        #bones, keys, constraints and groups the run changes, taken back when it is cancelled or fails
+        self.journal = Journal()
+        self.steps = generate_rigs_steps(context, rigs, self.force, self.journal)
+        window_manager = context.window_manager
+        self.timer = window_manager.event_timer_add(0.01, window=context.window)
+        window_manager.modal_handler_add(self)
+        window_manager.progress_begin(0, 100)
+        modal_progress = ("plan", 0.0)
+        return {'RUNNING_MODAL'}
 
-        #generate action with keyframes
-        self.generate_action(context, _ACTION_NAME)
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.finish(context)
+            self.rollback(context)
+            self.report({'INFO'}, "Lid rig generate cancelled")
+            return {'CANCELLED'}
+        if event.type != 'TIMER':
+            return {'RUNNING_MODAL'} #block edits while bones are half built
+        deadline = time.perf_counter() + _CHUNK_SECONDS
+        try:
+            while time.perf_counter() < deadline:
+                stage, done, total = next(self.steps)
+        except StopIteration as done:
+            self.finish(context)
+            if not done.value:
+                self.report({'INFO'}, "Lid rig is up to date")
+            return {'FINISHED'}
+        except Exception as error:
+            self.finish(context)
+            self.rollback(context)
+            self.report({'ERROR'}, f"Lid rig generate failed: {error}")
+            return {'CANCELLED'}
+        self.show_progress(context, stage, done / max(total, 1))
+        return {'RUNNING_MODAL'}
+
+    def show_progress(self, context, stage: str, fraction: float):
+        global modal_progress
+        overall = (_GENERATE_STAGES.index(stage) + min(fraction, 1.0)) / len(_GENERATE_STAGES)
+        modal_progress = (stage, overall)
+        context.window_manager.progress_update(int(overall * 100))
+        context.workspace.status_text_set(f"Generating lid rigs: {stage} {overall:.0%}, ESC to cancel")
+        for area in context.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+    def rollback(self, context):
+        self.steps.close() #ends open profile stages
+        self.journal.undo(context)
+
+    def finish(self, context):
+        global modal_progress
+        modal_progress = None
+        window_manager = context.window_manager
+        window_manager.event_timer_remove(self.timer)
+        window_manager.progress_end()
+        context.workspace.status_text_set(None)
+        for area in context.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+class VIEW3D_OT_vizor_bake_lid_shape_key(bpy.types.Operator):
+    bl_idname = "object.vizor_bake_lid_shape_key"
+    bl_label = "Bake lid close to shape key"
+
+    lidIndex: bpy.props.IntProperty(default=0)
+    remove_rig: bpy.props.BoolProperty(name="Remove rig", description="Delete lid bones, constraints and action after baking", default=False)
+    threshold: bpy.props.FloatProperty(name="Threshold", description="Smallest vertex movement written to the shape key", default=1e-6, min=0)
+
+    def execute(self, context):
+        rig = context.scene.lid_rigs[self.lidIndex]
+        with profiling(context.scene.lid_profile, context.scene.lid_cprofile):
+            moved = bake_lid_shape_key(context, rig, self.threshold)
+            if self.remove_rig:
+                remove_lid_rig(context, rig)
+        self.report({'INFO'}, f"{moved} verts baked to {side_name(_ACTION_NAME, rig.name)}")
         return {'FINISHED'}
 
+class VIEW3D_OT_vizor_transfer_lid_weights(bpy.types.Operator):
+    bl_idname = "object.vizor_transfer_lid_weights"
+    bl_label = "Transfer lid weights to selected meshes"
+
+    lidIndex: bpy.props.IntProperty(default=0)
+    max_distance: bpy.props.FloatProperty(name="Max distance", description="Farthest a vertex may be from the lid mesh surface", default=_TRANSFER_DISTANCE, min=0)
+
+    def execute(self, context):
+        rig = context.scene.lid_rigs[self.lidIndex]
+        source = get_object(rig.mesh_object, "Mesh Object")
+        targets = [obj for obj in context.selected_objects if obj.type == 'MESH' and obj != source]
+        if not targets:
+            self.report({'WARNING'}, "Select the meshes that follow the lid")
+            return {'CANCELLED'}
+        if bpy.context.mode != 'OBJECT':
+            mode_set('OBJECT')
+        with profiling(context.scene.lid_profile, context.scene.lid_cprofile):
+            count = transfer_lid_weights(source, targets, rig_weight_groups(rig), self.max_distance)
+        self.report({'INFO'}, f"{count} verts of {len(targets)} meshes weighted from {source.name}")
+        return {'FINISHED'}
+
+class VIEW3D_OT_vizor_assign_vertex_weights(bpy.types.Operator):
+    bl_idname = "object.vizor_assign_vertex_weights"
+    bl_label = "Assign DEF weights from the vertex records of the active mesh"
+
+    prop: bpy.props.StringProperty(name="Records", description="Object property holding the vertex records", default="vertices")
+    radius: bpy.props.FloatProperty(name="Falloff radius", description="Geodesic falloff distance over the surface, 0 weights the stored vertices only", default=0.0, min=0, subtype='DISTANCE')
+    create_groups: bpy.props.BoolProperty(name="Create groups", description="Add missing DEF- vertex groups", default=True)
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj is not None and obj.type == 'MESH'
+
+    def invoke(self, context, event):
+        return context.window_manager.invoke_props_dialog(self)
+
+    def execute(self, context):
+        obj = context.active_object
+        if self.prop not in obj:
+            self.report({'WARNING'}, f"{obj.name} has no {self.prop} vertex records")
+            return {'CANCELLED'}
+        if bpy.context.mode != 'OBJECT':
+            mode_set('OBJECT') #vertex groups are written on the object data
+        with profiling(context.scene.lid_profile, context.scene.lid_cprofile):
+            with profile_stage("assign_weights", len(obj.data.vertices)):
+                eye_bones.assign_weights(obj, self.prop, self.create_groups, self.radius)
+        self.report({'INFO'}, f"{self.prop} weights assigned on {obj.name}")
+        return {'FINISHED'}
+
+class VIEW3D_OT_vizor_export_lids(bpy.types.Operator, ExportHelper):
+    bl_idname = "object.vizor_export_lids"
+    bl_label = "Export lid definition"
+
+    filename_ext = ".vzlid"
+    filter_glob: bpy.props.StringProperty(default="*.vzlid", options={'HIDDEN'})
+
+    def execute(self, context):
+        scene = context.scene
+        mesh_object = scene.lid_rigs[scene.lid_rig_index].mesh_object
+        #rigs of the active rig's mesh, a file holds one topology
+        count = export_lid_definition(self.filepath, [rig for rig in scene.lid_rigs if rig.mesh_object == mesh_object])
+        self.report({'INFO'}, f"{count} lid rigs written to {self.filepath}")
+        return {'FINISHED'}
+
+class VIEW3D_OT_vizor_import_lids(bpy.types.Operator, ImportHelper):
+    bl_idname = "object.vizor_import_lids"
+    bl_label = "Import lid definition"
+
+    filename_ext = ".vzlid"
+    filter_glob: bpy.props.StringProperty(default="*.vzlid", options={'HIDDEN'})
+    use_active: bpy.props.BoolProperty(name="Active mesh", description="Apply the lids to the active mesh instead of the mesh named in the file", default=True)
+
+    def execute(self, context):
+        obj = context.active_object
+        mesh_obj = obj if self.use_active and obj and obj.type == 'MESH' else None
+        if bpy.context.mode != 'OBJECT':
+            mode_set('OBJECT')
+        names = import_lid_definition(context, self.filepath, mesh_obj)
+        context.scene.lid_rig_index = context.scene.lid_rigs.find(names[0]) if names else context.scene.lid_rig_index
+        self.report({'INFO'}, f"Lid rigs {', '.join(names)} imported")
+        return {'FINISHED'}
+
+class VIEW3D_OT_vizor_export_profile(bpy.types.Operator, ExportHelper):
+    bl_idname = "object.vizor_export_profile"
+    bl_label = "Export generate profile"
+
+    filename_ext = ".json"
+    format: bpy.props.EnumProperty(
+        items=[
+            ("JSON", "JSON", "Stage breakdown as JSON"),
+            ("PSTATS", "cProfile", "cProfile stats readable with pstats or snakeviz"),
+        ],
+        name="Format",
+        default="JSON",
+    )
+
+    @classmethod
+    def poll(cls, context):
+        return last_profile is not None
+
+    def check(self, context):
+        #ExportHelper swaps the file extension to filename_ext, which follows the format
+        self.filename_ext = _PROFILE_EXTENSIONS[self.format]
+        return super().check(context)
+
+    def invoke(self, context, event):
+        self.filename_ext = _PROFILE_EXTENSIONS[self.format]
+        return super().invoke(context, event)
+
+    def execute(self, context):
+        self.check(context) #cProfile stats never go to a .json file
+        match self.format:
+            case 'JSON':
+                with open(self.filepath, "w") as f:
+                    json.dump(last_profile.report(), f, indent=2)
+            case 'PSTATS':
+                if last_profile.cprofile is None:
+                    self.report({'ERROR'}, "The last generate has no cProfile, turn on Capture cProfile and generate again")
+                    return {'CANCELLED'}
+                pstats.Stats(last_profile.cprofile).dump_stats(self.filepath)
+        self.report({'INFO'}, f"Profile written to {self.filepath}")
+        return {'FINISHED'}
+
+class VIEW3D_OT_vizor_detect_lids(bpy.types.Operator):
+    bl_idname = "object.vizor_detect_lids"
+    bl_label = "Detect lids from the eye holes of the active mesh"
+
+    @classmethod
+    def poll(cls, context):
+        return context.active_object is not None and context.active_object.type == 'MESH'
+
+    def execute(self, context):
+        if bpy.context.mode != 'OBJECT':
+            mode_set('OBJECT') #write edit mesh changes back before the bulk reads
+        rigs = context.scene.lid_rigs
+        armature = rigs[context.scene.lid_rig_index].armature if 0 <= context.scene.lid_rig_index < len(rigs) else ''
+        with profiling(context.scene.lid_profile, context.scene.lid_cprofile):
+            names = detect_rig_lids(context, context.active_object, armature)
+        context.scene.lid_rig_index = context.scene.lid_rigs.find(names[0])
+        self.report({'INFO'}, f"Lids detected for {', '.join(names)}")
+        return {'FINISHED'}
+
+class VIEW3D_OT_vizor_add_remove_lid_rig(bpy.types.Operator):
+    bl_idname = "object.vizor_add_lid_rig"
+    bl_label = "Operator to add Lid rig"
+
+    lidIndex: bpy.props.IntProperty(default=0)
+    add: bpy.props.BoolProperty(default=True)
+
+    def execute(self, context):
+        scene = context.scene
+        match self.add:
+            case True:
+                rig = scene.lid_rigs.add()
+                count = len(scene.lid_rigs)
+                rig.name = {1: "L", 2: "R"}.get(count, f"lid{count}") #first two rigs are the left and right eye
+                #new rigs use the armature of the active rig
+                if len(scene.lid_rigs) > 1:
+                    rig.armature = scene.lid_rigs[scene.lid_rig_index].armature
+                scene.lid_rig_index = len(scene.lid_rigs) - 1
+            case False:
+                scene.lid_rigs.remove(self.lidIndex)
+                scene.lid_rig_index = min(scene.lid_rig_index, len(scene.lid_rigs) - 1)
+        return {'FINISHED'}
+
+class VIEW3D_UL_vizor_lid_rigs(bpy.types.UIList):
+    def draw_item(self, context, layout, data, item, icon, active_data, active_propname):
+        row = layout.row()
+        row.prop(item, "name", text="", emboss=False)
+        row.label(text=f"{len(item.upper.indices)}/{len(item.lower.indices)} verts")
+
 class VIEW3D_PT_rigging_vizor(bpy.types.Panel):
     bl_space_type = 'VIEW_3D'
     bl_region_type = 'UI'
     bl_category = 'Vizor Rigging'
     bl_label = 'Eye Lids'
 
-    def draw_lid(self, context, lid_layer):
+    def draw_lid(self, context, rig, lid_layer):
         #size of current lid indicies
-        lid_size = len((context.scene.upper_lid.indices if lid_layer == 'TOP' else context.scene.lower_lid.indices))
-        #dont DRAW bottom lid row if TOP is not set 
-        #if (lid_layer in ["BOTTOM", "Bottom"]):
-        #    if lid_size == 0 and len(context.scene.upper_lid.indices) == 0:
-        #        return None
+        lid_size = len((rig.upper.indices if lid_layer == 'TOP' else rig.lower.indices))
         layout = self.layout
         
-        
-        if context.scene.lid_armature and bpy.context.mode == 'EDIT_MESH' and context.tool_settings.mesh_select_mode[0] == True or lid_size > 0:
+        if rig.armature and bpy.context.mode == 'EDIT_MESH' and context.tool_settings.mesh_select_mode[0] == True or lid_size > 0:
             #draw add lid label with button
             #draw label
             up_lid_row = layout.row() # stack label and button
@@ -365,62 +1576,139 @@ class VIEW3D_PT_rigging_vizor(bpy.types.Panel):
                 #show - button operator
                 op = up_lid_row.operator(VIEW3D_OT_vizor_add_remove_lid.bl_idname, icon="REMOVE")
                 op.lidLayer = lid_layer
-                op.lidIndex = 0 #you might want multiple lids attached using action
+                op.lidIndex = context.scene.lid_rig_index
                 op.add = False
             else:
                 #show + button operator
                 op = up_lid_row.operator(VIEW3D_OT_vizor_add_remove_lid.bl_idname, icon="PLUS")
                 op.lidLayer = lid_layer
-                op.lidIndex = 0 #you might want multiple lids attached using action
+                op.lidIndex = context.scene.lid_rig_index
                 op.add = True
         
     def draw(self, context):
         layout = self.layout
+        scene = context.scene
 
-        
+        #LID RIGS LIST
+        row = layout.row()
+        row.template_list("VIEW3D_UL_vizor_lid_rigs", "", scene, "lid_rigs", scene, "lid_rig_index", rows=2)
+        col = row.column(align=True)
+        col.operator(VIEW3D_OT_vizor_add_remove_lid_rig.bl_idname, icon="ADD", text="").add = True
+        if len(scene.lid_rigs):
+            op = col.operator(VIEW3D_OT_vizor_add_remove_lid_rig.bl_idname, icon="REMOVE", text="")
+            op.lidIndex = scene.lid_rig_index
+            op.add = False
+        obj = context.active_object
+        if obj is not None and obj.type == 'MESH' and "vertices" in obj:
+            #draw Weights button, DEF weights of the vertex records, with a falloff when a radius is set
+            row = layout.row()
+            row.label(text='Assign weights')
+            row.operator(VIEW3D_OT_vizor_assign_vertex_weights.bl_idname, text="assign")
+        if not 0 <= scene.lid_rig_index < len(scene.lid_rigs):
+            return
+        rig = scene.lid_rigs[scene.lid_rig_index]
 
         #ARMATURE ADD
         layout.label(text='Fisrt select the Armature for Rig')
         layout.prop_search(
-            data=context.scene, # Object data to store the result
-            property="lid_armature",    # Property to store the selected material
-            search_data=bpy.data,          # Where to search for materials
-            search_property="armatures",   # Property that holds the list of materials
+            data=rig, # Object data to store the result
+            property="armature",    # Property to store the selected armature
+            search_data=bpy.data,          # Where to search for armatures
+            search_property="armatures",   # Property that holds the list of armatures
             text="Armature"                # Label for the field
         )
 
         #draw next layout for vertex selection
-        if context.scene.lid_armature:
+        if rig.armature:
             layout.label(text='(EDIT mode) select vertices and add them using + ')
+            layout.operator(VIEW3D_OT_vizor_detect_lids.bl_idname, text="Detect lids", icon="VIEWZOOM")
+        row = layout.row(align=True)
+        row.operator(VIEW3D_OT_vizor_import_lids.bl_idname, text="Import lids", icon="IMPORT")
+        if rig.mesh_object:
+            row.operator(VIEW3D_OT_vizor_export_lids.bl_idname, text="Export lids", icon="EXPORT")
+
+        #BONE BUDGET AND EVALUATION MODE
+        layout.prop(rig, "mode")
+        layout.prop(rig, "bone_count")
+        layout.prop(rig, "mirror")
 
         #UPPER LID ADD/REMOVE
-        self.draw_lid(context, 'TOP')
+        self.draw_lid(context, rig, 'TOP')
             
-        #UPPER LID ADD/REMOVE
-        self.draw_lid(context, 'BOTTOM')
+        #LOWER LID ADD/REMOVE
+        self.draw_lid(context, rig, 'BOTTOM')
         
         #GENERATE
-        if context.scene.upper_lid.indices and context.scene.lower_lid.indices:
+        if modal_progress is not None:
+            stage, fraction = modal_progress
+            layout.label(text=f"Generating {stage} {fraction:.0%}, ESC to cancel", icon="TIME")
+            return
+        #the modal generate is interrupted between chunks, profiling needs the synchronous one
+        generate = VIEW3D_OT_vizor_generate_lid_rig if scene.lid_profile else VIEW3D_OT_vizor_generate_lid_rig_modal
+        if len(rig.upper.indices) and len(rig.lower.indices):
             #draw Generate button
             row = layout.row()
             row.label(text='Generate rig')
-            row.operator(VIEW3D_OT_vizor_generate_lid_rig.bl_idname, text="generate")
+            row.operator(generate.bl_idname, text="generate").lidIndex = scene.lid_rig_index
+        if rig.ctrl_bone:
+            #draw Bake button
+            row = layout.row()
+            row.label(text='Bake to shape key')
+            row.operator(VIEW3D_OT_vizor_bake_lid_shape_key.bl_idname, text="bake").lidIndex = scene.lid_rig_index
+            #draw Transfer button, copies the lid weights onto the selected lash and tear line meshes
+            row = layout.row()
+            row.label(text='Transfer weights')
+            row.operator(VIEW3D_OT_vizor_transfer_lid_weights.bl_idname, text="transfer").lidIndex = scene.lid_rig_index
+        if len(scene.lid_rigs) > 1:
+            row = layout.row()
+            row.label(text='Generate all rigs')
+            if scene.lid_profile:
+                row.operator(VIEW3D_OT_vizor_generate_all_lid_rigs.bl_idname, text="generate all")
+            else:
+                row.operator(VIEW3D_OT_vizor_generate_lid_rig_modal.bl_idname, text="generate all").all = True
 
+        #PROFILE
+        layout.prop(scene, "lid_profile")
+        if scene.lid_profile:
+            layout.prop(scene, "lid_cprofile")
+        if scene.lid_profile and last_profile is not None:
+            self.draw_profile(last_profile.report())
+
+    def draw_profile(self, report: dict):
+        box = self.layout.box()
+        box.label(text=f"Last generate {report['total'] * 1000:.1f} ms" + (", with cProfile overhead" if report["cprofile"] else ""))
+        for stage in report["stages"]:
+            row = box.row()
+            row.label(text=stage["name"])
+            row.label(text=f"{stage['seconds'] * 1000:.1f} ms")
+            row.label(text=f"{stage['bones']} bones" if stage["bones"] else "")
+        box.label(text=f"{report['mode_switches']} mode switches, {report['depsgraph_updates']} depsgraph updates")
+        box.operator(VIEW3D_OT_vizor_export_profile.bl_idname, text="Export", icon="EXPORT")
 
-        
-  
 classes = (
+    Lid,
+    LidRig,
+    VIEW3D_UL_vizor_lid_rigs,
     VIEW3D_PT_rigging_vizor,
     VIEW3D_OT_vizor_add_remove_lid,
+    VIEW3D_OT_vizor_add_remove_lid_rig,
+    VIEW3D_OT_vizor_detect_lids,
     VIEW3D_OT_vizor_generate_lid_rig,
+    VIEW3D_OT_vizor_generate_all_lid_rigs,
+    VIEW3D_OT_vizor_generate_lid_rig_modal,
+    VIEW3D_OT_vizor_bake_lid_shape_key,
+    VIEW3D_OT_vizor_transfer_lid_weights,
+    VIEW3D_OT_vizor_assign_vertex_weights,
+    VIEW3D_OT_vizor_export_lids,
+    VIEW3D_OT_vizor_import_lids,
+    VIEW3D_OT_vizor_export_profile,
 )
 def register_properties():
     scene = bpy.types.Scene #property space
-    scene.lid_armature = bpy.props.StringProperty(name="Armature")
-    scene.lid_object = bpy.props.StringProperty(name="Mesh object")
-    scene.lid_ctrl_bone = bpy.props.StringProperty(name="Action Controller bone")
-    scene.upper_lid = Lid()
-    scene.lower_lid = Lid()
+    scene.lid_rigs = bpy.props.CollectionProperty(type=LidRig)
+    scene.lid_rig_index = bpy.props.IntProperty(name="Active lid rig")
+    scene.lid_profile = bpy.props.BoolProperty(name="Profile generate", description="Record stage timings of generate", default=False)
+    scene.lid_cprofile = bpy.props.BoolProperty(name="Capture cProfile", description="Also record a cProfile for the pstats export, adds its overhead to the stage timings", default=False)
 
     
 
@@ -428,10 +1716,15 @@ def register():
     for cls in classes:
         bpy.utils.register_class(cls)
     register_properties()
+    eye_bones.register()
+
+def unregister_properties():
+    scene = bpy.types.Scene
+    for prop in ("lid_rigs", "lid_rig_index", "lid_profile", "lid_cprofile"):
+        delattr(scene, prop)
 
 def unregister():
+    eye_bones.unregister()
+    unregister_properties()
     for cls in reversed(classes):
         bpy.utils.unregister_class(cls)
-
-if __name__== "__main__":
-    register()
\ No newline at end of file